@@ -0,0 +1,95 @@
+# delivery_ledger.py
+"""
+Журнал доставленных уведомлений (SQLite): ключ — (пользователь, слот, дата расписания).
+
+Перед отправкой уведомления ключ «занимается» в журнале; если он уже занят
+(повторная регистрация, перезапуск бота, двойной тик), уведомление не
+отправляется. Так каждое уведомление уходит не больше одного раза за слот,
+в том числе между перезапусками.
+"""
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Iterable, Set, Tuple
+
+from paths import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Конфигурация --------------------
+DB_PATH = os.path.join(DATA_DIR, "deliveries.db")
+KEEP_DAYS = 7   # сколько дней хранить записи
+
+_counters = {"claimed": 0, "suppressed": 0}
+_pruned_on = None
+
+
+# -------------------- SQLite --------------------
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_db():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = _connect()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS deliveries (
+            user_id INTEGER,
+            slot TEXT,
+            target_date TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (user_id, slot, target_date)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_date ON deliveries (target_date)")
+    conn.commit()
+    conn.close()
+    prune()
+
+
+def prune():
+    """Удалить записи старше KEEP_DAYS дней."""
+    global _pruned_on
+    _pruned_on = datetime.now().date()
+    border = (datetime.now() - timedelta(days=KEEP_DAYS)).strftime("%Y.%m.%d")
+    conn = _connect()
+    conn.execute("DELETE FROM deliveries WHERE target_date < ?", (border,))
+    conn.commit()
+    conn.close()
+
+
+def claim_many(slot: str, keys: Iterable[Tuple[int, str]]) -> Set[Tuple[int, str]]:
+    """
+    Занять ключи (user_id, дата расписания) слота slot одной транзакцией.
+    Вернёт те, что заняты сейчас; остальные уже были доставлены — их пропускаем.
+    """
+    if _pruned_on != datetime.now().date():
+        prune()
+    keys = list(keys)
+    sent_at = datetime.now().isoformat(timespec="seconds")
+    claimed = set()
+    conn = _connect()
+    try:
+        with conn:
+            for user_id, target_date in keys:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?)",
+                    (int(user_id), slot, target_date, sent_at),
+                )
+                if cur.rowcount == 1:
+                    claimed.add((user_id, target_date))
+    finally:
+        conn.close()
+    _counters["claimed"] += len(claimed)
+    suppressed = len(keys) - len(claimed)
+    if suppressed:
+        _counters["suppressed"] += suppressed
+        logger.info("Слот %s: %d повторных уведомлений не отправлено", slot, suppressed)
+    return claimed
+
+
+def stats() -> dict:
+    return dict(_counters)
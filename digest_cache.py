@@ -0,0 +1,99 @@
+# digest_cache.py
+"""
+Кеш готовых дайджестов дня: расписание группы на дату + ДЗ, уже в HTML.
+
+Один и тот же текст нужен каждому, кто смотрит «сегодня/завтра» этой группы,
+и всем подписчикам уведомлений. Он собирается один раз и дальше отдаётся из
+памяти. Запись сбрасывается, когда меняется расписание этого дня (сигнал от
+timetable_cache) или ДЗ группы (add_homework), и в любом случае живёт не
+дольше TTL — чтобы расписание всё равно перепроверялось в источнике.
+
+Ответы из локальной копии (источник недоступен) не кешируются.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+import timetable_cache as TC
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+TTL = TC.FRESH_TTL     # сек: не дольше, чем день считается свежим в кеше расписаний
+MAX_DIGESTS = 5000
+
+Key = Tuple[str, str, str]   # (id группы, дата YYYY.MM.DD, название группы)
+
+
+class Digest(NamedTuple):
+    schedule: str              # расписание дня (HTML)
+    homework: Optional[str]    # ДЗ на этот день (HTML) или None
+    cacheable: bool = True     # False — данные из локальной копии, не запоминаем
+
+
+_digests: "OrderedDict[Key, Tuple[float, Digest]]" = OrderedDict()
+_by_day: Dict[Tuple[str, str], Set[Key]] = {}
+_by_group_name: Dict[str, Set[Key]] = {}
+_counters = {"hits": 0, "misses": 0, "invalidated": 0}
+
+
+def _drop(key: Key):
+    if _digests.pop(key, None) is None:
+        return
+    gid, ds, gname = key
+    for index, ikey in ((_by_day, (gid, ds)), (_by_group_name, gname)):
+        keys = index.get(ikey)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[ikey]
+
+
+def _put(key: Key, digest: Digest):
+    _drop(key)
+    _digests[key] = (time.monotonic() + TTL, digest)
+    gid, ds, gname = key
+    _by_day.setdefault((gid, ds), set()).add(key)
+    _by_group_name.setdefault(gname, set()).add(key)
+    while len(_digests) > MAX_DIGESTS:
+        _drop(next(iter(_digests)))
+
+
+async def get(gid, ds: str, gname: str, render: Callable[[str, str, str], Awaitable[Digest]]) -> Digest:
+    """Дайджест из памяти или render(gid, ds, gname), если его нет или он сброшен."""
+    key = (str(gid), ds, gname)
+    item = _digests.get(key)
+    if item is not None and item[0] > time.monotonic():
+        _digests.move_to_end(key)
+        _counters["hits"] += 1
+        return item[1]
+    _counters["misses"] += 1
+    digest = await render(*key)
+    if digest.cacheable:
+        _put(key, digest)
+    else:
+        _drop(key)
+    return digest
+
+
+# ====== Сброс ======
+def invalidate_day(gid, ds: str):
+    """Расписание группы на день изменилось."""
+    for key in list(_by_day.get((str(gid), ds), ())):
+        _drop(key)
+        _counters["invalidated"] += 1
+
+
+def invalidate_group_name(gname: str):
+    """У группы изменилось ДЗ (ДЗ привязано к названию группы, а не к id)."""
+    for key in list(_by_group_name.get(gname, ())):
+        _drop(key)
+        _counters["invalidated"] += 1
+
+
+def stats() -> dict:
+    return dict(_counters, entries=len(_digests))
+
+
+TC.on_change(invalidate_day)
@@ -0,0 +1,421 @@
+# fa_client.py
+"""
+Единая точка вызовов FaAPI.
+
+Одинаковые одновременные запросы склеиваются (single-flight): пока запрос
+с тем же ключом в полёте, остальные вызывающие ждут его и получают тот же
+результат или ту же ошибку. Число одновременных запросов к источнику
+ограничено числом разных ключей, а не числом пользователей.
+
+Сами (блокирующие) вызовы FaAPI выполняются в отдельном ограниченном пуле
+потоков с таймаутом на вызов, чтобы не занимать цикл событий бота. Таймаут
+вызова отсчитывается с момента, когда запрос реально начался; ожидание в
+очереди ограничено отдельно (FA_QUEUE_TIMEOUT) и источнику в вину не ставится.
+Фоновая работа (прогрев, уведомления — lanes.background()) идёт через свой
+пул на FA_BULK_WORKERS потоков и не занимает потоки обработчиков кнопок.
+
+Клиент FaAPI один на весь бот (get_client()): HTTP-соединения с источником
+держатся открытыми (keep-alive) и переиспользуются из общего пула.
+
+Все вызовы идут через предохранитель (circuit breaker). Если среди последних
+вызовов слишком много ошибок или слишком медленных ответов (считается время
+самого запроса, без ожидания в очереди), он размыкается,
+и следующие BREAKER_OPEN_SEC секунд вызовы сразу получают SourceUnavailable —
+вызывающий отдаёт локальную копию, а не ждёт таймаутов. Затем пропускается
+несколько пробных вызовов: если они успешны — предохранитель замыкается.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import requests
+from fa_api import FaAPI
+import lanes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+FA_MAX_WORKERS = int(os.getenv("FA_MAX_WORKERS", "8"))        # одновременных запросов к источнику
+FA_BULK_WORKERS = int(os.getenv("FA_BULK_WORKERS", "2"))      # ещё столько — для фоновой работы
+FA_CALL_TIMEOUT = float(os.getenv("FA_CALL_TIMEOUT", "20"))   # сек на один вызов
+FA_QUEUE_WARN = int(os.getenv("FA_QUEUE_WARN", "32"))         # предупреждать, если очередь длиннее
+FA_QUEUE_TIMEOUT = float(os.getenv("FA_QUEUE_TIMEOUT", "60")) # сек ожидания в очереди до начала запроса
+FA_POOL_SIZE = int(os.getenv("FA_POOL_SIZE", str(FA_MAX_WORKERS + FA_BULK_WORKERS)))  # keep-alive соединений
+FA_HTTP_TIMEOUT = (5, 15)                                     # сек: (соединение, чтение ответа)
+
+BREAKER_WINDOW = 20          # по скольким последним вызовам считаем долю ошибок
+BREAKER_MIN_CALLS = 5        # меньше вызовов в окне — не размыкаем
+BREAKER_ERROR_RATE = 0.5     # доля ошибок/медленных ответов, при которой размыкаем
+BREAKER_SLOW_CALL_SEC = 8.0  # ответ дольше — считается медленным
+BREAKER_OPEN_SEC = 30        # сек в разомкнутом состоянии до пробных вызовов
+BREAKER_PROBES = 2           # успешных пробных вызовов, чтобы замкнуться
+
+
+# ====== Клиент ======
+class PooledFaAPI(FaAPI):
+    """
+    FaAPI поверх общего пула соединений. Библиотечный FaAPI ходит через
+    requests.get, то есть на каждый запрос — новое TCP/TLS-соединение.
+    Здесь у каждого потока своя Session, но все они смонтированы на один
+    HTTPAdapter, так что пул соединений urllib3 (потокобезопасный) общий.
+    """
+
+    def __init__(self, pool_size: int):
+        retry = Retry(total=1, connect=1, read=0, status=0, other=1, backoff_factor=0.2)
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                    pool_block=True, max_retries=retry)
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = requests.Session()
+            s.mount("https://", self._adapter)
+            s.mount("http://", self._adapter)
+            s.verify = False  # как в fa_api: у ruz.fa.ru проблемы с цепочкой сертификатов
+            s.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+            self._local.session = s
+        return s
+
+    def _FaAPI__request(self, sub_url: str):
+        """Запрос к РУЗ (подменяет приватный FaAPI.__request)."""
+        url = self.HOST + sub_url
+        r = self._session().get(url, timeout=FA_HTTP_TIMEOUT)
+        if r.status_code == 200:
+            return r.json()
+        raise requests.exceptions.HTTPError(
+            "[Ошибка] RUZ отдал код {}!\nURL: '{}'".format(r.status_code, url), response=r
+        )
+
+
+_client: Optional[PooledFaAPI] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> FaAPI:
+    """Общий потокобезопасный клиент FaAPI."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PooledFaAPI(FA_POOL_SIZE)
+    return _client
+
+
+class SourceUnavailable(Exception):
+    """Источник считается недоступным: вызов отклонён предохранителем без запроса."""
+
+
+class QueueTimeout(Exception):
+    """Запрос так и не начался: слишком долго ждал свободного потока (источник тут ни при чём)."""
+
+
+def _is_failure(exc: BaseException) -> bool:
+    """Ошибки, говорящие о проблемах самого источника (сеть, таймаут, 5xx)."""
+    if isinstance(exc, (TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError):
+        resp = exc.response
+        return resp is None or resp.status_code >= 500
+    return False
+
+
+def is_source_down(exc: BaseException) -> bool:
+    """Ответа от источника сейчас не получить: предохранитель, перегруженная очередь, сеть/таймаут/5xx."""
+    return isinstance(exc, (SourceUnavailable, QueueTimeout)) or _is_failure(exc)
+
+
+class CircuitBreaker:
+    """Предохранитель: CLOSED -> OPEN (по доле ошибок/медленных ответов) -> HALF_OPEN (пробы) -> CLOSED."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: int, min_calls: int, error_rate: float,
+                 slow_call_sec: float, open_sec: float, probes: int):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_sec = slow_call_sec
+        self.open_sec = open_sec
+        self.probes = probes
+        self.state = self.CLOSED
+        self._results = deque(maxlen=window)   # True — вызов неудачный или медленный
+        self._opened_at = 0.0
+        self._probes_inflight = 0
+        self._probes_ok = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("Предохранитель FaAPI: %s -> %s", self.state, state)
+            self.state = state
+
+    def allow(self) -> bool:
+        """Можно ли сейчас идти в источник; False — отказать сразу."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_sec:
+                self.rejected += 1
+                return False
+            self._set_state(self.HALF_OPEN)
+            self._probes_inflight = 0
+            self._probes_ok = 0
+        if self.state == self.HALF_OPEN:
+            if self._probes_inflight + self._probes_ok >= self.probes:
+                self.rejected += 1
+                return False
+            self._probes_inflight += 1
+        return True
+
+    def release(self):
+        """Вызов не завершился (отменён): освободить слот пробы, не считая результат."""
+        if self.state == self.HALF_OPEN:
+            self._probes_inflight = max(0, self._probes_inflight - 1)
+
+    def record(self, elapsed: float, exc: Optional[BaseException] = None):
+        bad = (exc is not None and _is_failure(exc)) or elapsed >= self.slow_call_sec
+        if self.state == self.HALF_OPEN:
+            self._probes_inflight = max(0, self._probes_inflight - 1)
+            if bad:
+                self._trip()
+            else:
+                self._probes_ok += 1
+                if self._probes_ok >= self.probes:
+                    self._results.clear()
+                    self._set_state(self.CLOSED)
+            return
+        if self.state == self.OPEN:
+            return  # запоздавший ответ, отправленный до размыкания
+        self._results.append(bad)
+        failures = sum(self._results)
+        if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+            self._trip()
+
+    def _trip(self):
+        self.trips += 1
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self._set_state(self.OPEN)
+
+    def stats(self) -> dict:
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(0.0, self.open_sec - (time.monotonic() - self._opened_at))
+        return {
+            "state": self.state,
+            "window_calls": len(self._results),
+            "window_failures": sum(self._results),
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "retry_in": round(retry_in, 1),
+        }
+
+
+class FaExecutor:
+    """Ограниченный пул потоков для FaAPI с таймаутами и учётом очереди."""
+
+    def __init__(self, max_workers: int, name: str = "fa-api"):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.queue_timeouts = 0
+        self._warned = False
+
+    def _job(self, fn: Callable, args: tuple, loop: asyncio.AbstractEventLoop,
+             started: asyncio.Future) -> Tuple[float, Any]:
+        """(момент начала запроса, результат) — время в очереди сюда не входит."""
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        t0 = time.monotonic()
+        try:
+            loop.call_soon_threadsafe(_resolve, started, t0)
+        except RuntimeError:
+            pass  # цикл событий уже закрыт
+        try:
+            return t0, fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+
+    def _check_queue(self, queued: int):
+        """Одно предупреждение на перегрузку очереди, а не на каждый запрос."""
+        if queued > FA_QUEUE_WARN and not self._warned:
+            self._warned = True
+            logger.warning("Очередь %s: %d ожидают, %d выполняются", self.name, queued, self._running)
+        elif queued <= FA_QUEUE_WARN // 2:
+            self._warned = False
+
+    def _dequeue(self, cf) -> bool:
+        """Снять ещё не начавшийся запрос; False — он уже выполняется."""
+        if not cf.cancel():
+            return False
+        with self._lock:
+            self._queued -= 1
+        return True
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None,
+                  on_done: Optional[Callable[[float, Optional[BaseException]], None]] = None) -> Any:
+        """
+        on_done(сек, ошибка) вызывается, только если запрос реально выполнялся:
+        время — от начала запроса в потоке, без ожидания в очереди.
+        """
+        timeout = FA_CALL_TIMEOUT if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+        with self._lock:
+            self._queued += 1
+            queued = self._queued
+        self._check_queue(queued)
+
+        cf = self._pool.submit(self._job, fn, args, loop, started)
+        done = asyncio.wrap_future(cf)
+        try:
+            # 1) ждём свободный поток — это не время источника
+            try:
+                began = await asyncio.wait_for(asyncio.shield(started), FA_QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self._dequeue(cf):
+                    self.queue_timeouts += 1
+                    raise QueueTimeout(f"FaAPI: запрос не начался за {FA_QUEUE_TIMEOUT:g} c, очередь перегружена") from None
+                began = await started   # начался в последний момент
+            # 2) таймаут самого вызова — с момента начала
+            try:
+                began, result = await asyncio.wait_for(done, max(0.0, timeout - (time.monotonic() - began)))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                err = TimeoutError(f"FaAPI: запрос не уложился в {timeout:g} c (timed out)")
+                _notify(on_done, time.monotonic() - began, err)
+                raise err from None
+            except Exception as e:
+                _notify(on_done, time.monotonic() - began, e)
+                raise
+            _notify(on_done, time.monotonic() - began, None)
+            return result
+        except asyncio.CancelledError:
+            self._dequeue(cf)
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "queue_timeouts": self.queue_timeouts,
+            }
+
+
+def _resolve(fut: asyncio.Future, value: Any):
+    if not fut.done():
+        fut.set_result(value)
+
+
+def _notify(on_done: Optional[Callable], elapsed: float, exc: Optional[BaseException]):
+    if on_done is not None:
+        on_done(elapsed, exc)
+
+
+class SingleFlight:
+    """Склейка одновременных вызовов с одинаковым ключом."""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+        # shield: отмена одного ждущего не отменяет общий запрос для остальных
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # помечаем ошибку как полученную, даже если все ждущие ушли
+
+    def stats(self) -> dict:
+        return {"inflight": len(self._inflight), "started": self.started, "coalesced": self.coalesced}
+
+
+_flight = SingleFlight()
+_executor = FaExecutor(FA_MAX_WORKERS)
+_bulk_executor = FaExecutor(FA_BULK_WORKERS, "fa-api-bulk")
+_breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+                          BREAKER_SLOW_CALL_SEC, BREAKER_OPEN_SEC, BREAKER_PROBES)
+
+
+# ====== Вызовы ======
+async def _guarded(fn: Callable, args: tuple, timeout: Optional[float]) -> Any:
+    if not _breaker.allow():
+        raise SourceUnavailable("FaAPI: источник недоступен (service unavailable), запрос не отправлялся")
+    recorded = False
+
+    def _record(elapsed: float, exc: Optional[BaseException]):
+        nonlocal recorded
+        recorded = True
+        _breaker.record(elapsed, exc)   # только время самого запроса, без очереди
+
+    try:
+        executor = _bulk_executor if lanes.in_background() else _executor
+        return await executor.run(fn, *args, timeout=timeout, on_done=_record)
+    finally:
+        if not recorded:
+            _breaker.release()  # отменили мы сами или запрос не начался — об источнике это ничего не говорит
+
+
+async def call(key: Hashable, fn: Callable, *args, timeout: Optional[float] = None) -> Any:
+    """
+    Выполнить блокирующий fn(*args) в пуле FaAPI; одновременные вызовы с одним key склеиваются.
+    Пока предохранитель разомкнут — сразу SourceUnavailable.
+    """
+    return await _flight.do(key, lambda: _guarded(fn, args, timeout))
+
+
+async def search_group(query: str):
+    return await call(("search_group", query), get_client().search_group, query)
+
+
+async def timetable_group(gid, date_begin: str, date_end: str):
+    gid = str(gid)
+    return await call(("timetable_group", gid, date_begin, date_end),
+                      get_client().timetable_group, gid, date_begin, date_end)
+
+
+def flight_stats() -> dict:
+    return _flight.stats()
+
+
+def executor_stats() -> dict:
+    return {**_executor.stats(), "bulk": _bulk_executor.stats()}
+
+
+def breaker_stats() -> dict:
+    return _breaker.stats()
+
+
+def source_available() -> bool:
+    """False, пока предохранитель разомкнут (для фоновых задач: не тратить время зря)."""
+    return _breaker.state != CircuitBreaker.OPEN
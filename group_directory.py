@@ -0,0 +1,221 @@
+# group_directory.py
+"""
+Локальный справочник групп для ask_group.
+
+Список групп меняется пару раз в год, поэтому название группы ищется
+в памяти по нормализованному ключу: точное совпадение, префикс и опечатка
+на одну букву («би25-3», «БИ 25-3», латинские буквы-двойники вместо
+кириллицы). Справочник заполняется ответами источника и может быть неполным,
+поэтому без источника (FaAPI.search_group) обходится только точное совпадение;
+префикс и опечатка — подсказки на случай, когда источник недоступен.
+Всё, что вернул источник, тоже попадает в справочник.
+
+Справочник хранится в data/groups.json и раз в сутки обновляется
+повторным поиском по известным буквенным префиксам групп.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+
+import fa_client as FC
+from paths import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+DIR_FILE = os.path.join(DATA_DIR, "groups.json")
+REFRESH_INTERVAL = 24 * 60 * 60   # сек между обновлениями справочника
+MAX_RESULTS = 10
+
+EXACT, PREFIX, FUZZY = "exact", "prefix", "fuzzy"
+
+# латинские буквы, которые на клавиатуре/на вид не отличить от кириллических
+_LOOKALIKES = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м",
+    "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е",
+})
+_NON_KEY_RE = re.compile(r"[^0-9a-zа-я]")
+
+
+def normalize(name: str) -> str:
+    """«БИ 25–3», «bи25-3» -> «би253»."""
+    s = (name or "").strip().lower().translate(_LOOKALIKES)
+    return _NON_KEY_RE.sub("", s)
+
+
+def _group_label(g: dict) -> str:
+    return str(g.get("label") or g.get("name") or g.get("title") or "").strip()
+
+
+def _deletes(key: str) -> Set[str]:
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+class GroupDirectory:
+    """Индекс групп: ключ -> группы, отсортированные ключи для префиксов, удаления для опечаток."""
+
+    def __init__(self):
+        self._groups: Dict[str, dict] = {}            # id -> группа
+        self._by_key: Dict[str, List[dict]] = {}
+        self._keys: List[str] = []
+        self._by_delete: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._groups)
+
+    def groups(self) -> List[dict]:
+        with self._lock:
+            return list(self._groups.values())
+
+    def replace(self, groups: Iterable[dict]):
+        with self._lock:
+            self._groups = {}
+            self._add(groups)
+            self._rebuild()
+
+    def add_many(self, groups: Iterable[dict]) -> int:
+        """Добавить группы; вернёт число новых или изменившихся."""
+        with self._lock:
+            added = self._add(groups)
+            if added:
+                self._rebuild()
+            return added
+
+    def _add(self, groups: Iterable[dict]) -> int:
+        added = 0
+        for g in groups or []:
+            if not isinstance(g, dict) or not g.get("id") or not _group_label(g):
+                continue
+            if g.get("type") not in (None, "group"):
+                continue
+            if self._groups.get(str(g["id"])) != g:
+                added += 1
+            self._groups[str(g["id"])] = g
+        return added
+
+    def _rebuild(self):
+        by_key: Dict[str, List[dict]] = {}
+        by_delete: Dict[str, Set[str]] = {}
+        for g in self._groups.values():
+            key = normalize(_group_label(g))
+            if not key:
+                continue
+            by_key.setdefault(key, []).append(g)
+            for d in _deletes(key):
+                by_delete.setdefault(d, set()).add(key)
+        self._by_key, self._keys, self._by_delete = by_key, sorted(by_key), by_delete
+
+    def lookup(self, query: str, limit: int = MAX_RESULTS) -> Tuple[List[dict], str]:
+        """Вернёт (группы, EXACT | PREFIX | FUZZY); пустой список — не нашли."""
+        q = normalize(query)
+        if not q:
+            return [], EXACT
+        by_key, keys, by_delete = self._by_key, self._keys, self._by_delete
+
+        if q in by_key:
+            return list(by_key[q]), EXACT
+
+        out: List[dict] = []
+        i = bisect.bisect_left(keys, q)
+        while i < len(keys) and keys[i].startswith(q) and len(out) < limit:
+            out.extend(by_key[keys[i]])
+            i += 1
+        if out:
+            return out[:limit], PREFIX
+
+        # одна лишняя, пропущенная или неверная буква
+        variants = _deletes(q) | {q}
+        cand: Set[str] = set()
+        for v in variants:
+            if v in by_key:
+                cand.add(v)
+            cand |= by_delete.get(v, set())
+        for key in sorted(cand):
+            out.extend(by_key[key])
+        return out[:limit], FUZZY
+
+    def prefixes(self) -> Set[str]:
+        """Буквенные префиксы известных групп («БИ», «ПИ», …) — затравки для обновления."""
+        out = set()
+        for g in self._groups.values():
+            m = re.match(r"^\s*([^\d\s]+)", _group_label(g))
+            if m:
+                out.add(m.group(1).strip("-– "))
+        return {p for p in out if p}
+
+
+directory = GroupDirectory()
+_loaded = False
+
+
+# ====== Файл ======
+def load():
+    global _loaded
+    _loaded = True
+    if not os.path.exists(DIR_FILE):
+        return
+    try:
+        with open(DIR_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        directory.replace(data.get("groups") or [])
+    except Exception as e:
+        logger.error(f"Ошибка чтения {DIR_FILE}: {e}")
+
+
+def save():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = DIR_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"updated_at": datetime.now().isoformat(timespec="seconds"),
+                   "groups": directory.groups()}, f, ensure_ascii=False)
+    os.replace(tmp, DIR_FILE)
+
+
+# ====== Поиск ======
+def lookup(query: str) -> Tuple[List[dict], str]:
+    if not _loaded:
+        load()
+    return directory.lookup(query)
+
+
+def remember(groups: Iterable[dict]):
+    """Запомнить группы из ответа источника."""
+    if not _loaded:
+        load()
+    if directory.add_many(groups):
+        try:
+            save()
+        except Exception as e:
+            logger.warning("Не удалось сохранить справочник групп: %s", e)
+
+
+# ====== Периодическое обновление ======
+async def refresh_job(context):
+    """Перезапрашивает источник по известным префиксам групп и дополняет справочник."""
+    if not _loaded:
+        load()
+    seeds = sorted(directory.prefixes())
+    if not seeds:
+        return
+    found: List[dict] = []
+    failed = 0
+    for term in seeds:
+        if not FC.source_available():
+            logger.warning("Обновление справочника групп прервано: источник недоступен")
+            break
+        try:
+            found.extend(await FC.search_group(term) or [])
+        except Exception as e:
+            failed += 1
+            logger.warning("Обновление справочника групп (%s): %s", term, e)
+    # только дополняем: поиск по префиксу может вернуть не все группы
+    directory.add_many(found)
+    await asyncio.to_thread(save)
+    logger.info("Справочник групп обновлён: %d групп, ошибок %d", len(directory), failed)
@@ -10,6 +10,8 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 import re
 import logging
+import send_queue as SQ
+import digest_cache as DC
 
 logger = logging.getLogger(__name__)
 
@@ -87,6 +89,7 @@ def add_homework(entry):
     ))
     conn.commit()
     conn.close()
+    DC.invalidate_group_name(entry["group"])  # готовые дайджесты группы устарели
 
 def get_homework_by_group(group_name):
     conn = sqlite3.connect(DB_PATH)
@@ -343,13 +346,20 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 # -------------------- Отправка домашки по дате --------------------
-async def send_homework_for_date(update, context, group: str, date_str: str):
+def format_homework_for_date(group: str, date_str: str):
+    """Текст ДЗ группы на дату или None, если заданий нет."""
     records = get_homework_by_date(group, date_str)
     if not records:
-        return
+        return None
     text_lines = [f"🧩 <b>Домашняя работа на {date_str}:</b>"]
     for hw in records:
         text_lines.append(f"📘 <b>{hw['subject']}</b>: {hw['task']} (до {hw['deadline']})")
         if hw["attachment"] and hw["attachment"] != "-":
             text_lines.append(f"📎 {hw['attachment']}")
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(text_lines), parse_mode="HTML")
\ No newline at end of file
+    return "\n".join(text_lines)
+
+async def send_homework_for_date(update, context, group: str, date_str: str, priority: int = SQ.PRIORITY_HIGH):
+    text = format_homework_for_date(group, date_str)
+    if not text:
+        return
+    await SQ.send_message(context.bot, update.effective_chat.id, text, priority=priority, parse_mode="HTML")
\ No newline at end of file
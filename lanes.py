@@ -0,0 +1,101 @@
+# lanes.py
+"""
+Две полосы трафика бота.
+
+Интерактивная — ответы на нажатия кнопок и сообщения: свой пул HTTP-соединений
+с Bot API (основной bot приложения).
+Фоновая — уведомления, почтовые оповещения, резервные копии: отдельный Bot со
+своим пулом соединений и отдельный пул потоков для блокирующей работы (IMAP,
+Google Sheets). Во время рассылки фоновая полоса может быть загружена целиком,
+а нажатия пользователей всё равно не ждут в её очереди.
+
+Общий код (кеш расписаний, дайджесты, FaAPI) вызывается из обеих полос.
+Фоновые задачи (прогрев, уведомления) оборачиваются в background(): внутри
+него run_io уходит в пул фоновой полосы, а FaAPI — в свой пул потоков
+(см. fa_client), и обработчики кнопок не ждут за рассылкой.
+"""
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+import send_queue as SQ
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+INTERACTIVE_POOL_SIZE = int(os.getenv("TG_INTERACTIVE_POOL", "16"))  # соединений с Bot API
+BULK_POOL_SIZE = int(os.getenv("TG_BULK_POOL", "4"))
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "4"))                   # потоков для фоновой работы
+HTTP_TIMEOUT = 30.0
+
+_bulk_bot: Optional[ExtBot] = None
+_bulk_pool = ThreadPoolExecutor(max_workers=BULK_WORKERS, thread_name_prefix="bulk")
+_background = contextvars.ContextVar("background_lane", default=False)
+
+
+def _request(pool_size: int) -> HTTPXRequest:
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        read_timeout=HTTP_TIMEOUT,
+        write_timeout=HTTP_TIMEOUT,
+        connect_timeout=HTTP_TIMEOUT,
+        pool_timeout=HTTP_TIMEOUT,
+    )
+
+
+def interactive_request() -> HTTPXRequest:
+    """Запросы основного bot приложения (интерактивная полоса)."""
+    return _request(INTERACTIVE_POOL_SIZE)
+
+
+# ====== Фоновая полоса ======
+async def start_bulk_lane(application):
+    """post_init: отдельный Bot для рассылок со своим пулом соединений."""
+    global _bulk_bot
+    _bulk_bot = ExtBot(application.bot.token, request=_request(BULK_POOL_SIZE),
+                       defaults=application.bot.defaults)
+    await _bulk_bot.initialize()
+    SQ.set_lane_bot(SQ.LANE_BULK, _bulk_bot)
+
+
+async def stop_bulk_lane(application):
+    """post_shutdown: закрыть соединения фоновой полосы."""
+    global _bulk_bot
+    SQ.set_lane_bot(SQ.LANE_BULK, None)
+    if _bulk_bot is not None:
+        await _bulk_bot.shutdown()
+        _bulk_bot = None
+    _bulk_pool.shutdown(wait=False)
+
+
+async def run_bulk(fn: Callable, *args) -> Any:
+    """Блокирующая фоновая работа — в своём пуле потоков, не в общем."""
+    return await asyncio.get_running_loop().run_in_executor(_bulk_pool, fn, *args)
+
+
+@contextlib.contextmanager
+def background():
+    """Код внутри (и задачи, запущенные из него) — фоновая работа."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def in_background() -> bool:
+    return _background.get()
+
+
+async def run_io(fn: Callable, *args) -> Any:
+    """Блокирующий вызов из общего кода: в фоновой работе — в пуле фоновой полосы, иначе — в общем."""
+    if _background.get():
+        return await run_bulk(fn, *args)
+    return await asyncio.to_thread(fn, *args)
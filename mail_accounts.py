@@ -0,0 +1,116 @@
+# mail_accounts.py
+"""
+Реестр подключённых почтовых ящиков (mail_accounts.json) в памяти.
+
+Индексы: по chat_id и по IMAP-серверу. Файл перечитывается только если
+изменились его mtime или размер (правка руками, другой процесс); запись
+через save обновляет память сразу и пишет файл атомарно (tmp + os.replace).
+В обычном режиме проверка почты раз в минуту делает один stat() и не
+разбирает JSON.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+Stamp = Tuple[int, int]   # (mtime_ns, размер файла)
+
+
+class AccountRegistry:
+    """server_of(email) — IMAP-сервер ящика (в боте это guess_imap_server)."""
+
+    def __init__(self, path: str, server_of: Callable[[str], str]):
+        self.path = path
+        self._server_of = server_of
+        self._by_chat: Dict[str, List[dict]] = {}
+        self._by_server: Dict[str, Set[Tuple[str, str]]] = {}   # сервер -> {(chat_id, email)}
+        self._stamp: Optional[Stamp] = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def __len__(self):
+        return sum(len(accounts) for accounts in self._by_chat.values())
+
+    # ---- файл ----
+    def _file_stamp(self) -> Optional[Stamp]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _refresh(self):
+        """Перечитать файл, если он изменился с прошлого чтения или записи."""
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return
+        data = {}
+        if stamp is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                logger.error(f"Ошибка чтения {self.path}: {e}")
+                return   # оставляем то, что было в памяти; попробуем на следующем вызове
+        self._by_chat = {
+            str(chat_id): [acc for acc in accounts if acc.get("email")]
+            for chat_id, accounts in (data.items() if isinstance(data, dict) else ())
+        }
+        self._rebuild_servers()
+        self._stamp = stamp
+        self.reloads += 1
+
+    def _rebuild_servers(self):
+        by_server: Dict[str, Set[Tuple[str, str]]] = {}
+        for chat_id, accounts in self._by_chat.items():
+            for acc in accounts:
+                by_server.setdefault(self._server_of(acc["email"]), set()).add((chat_id, acc["email"]))
+        self._by_server = by_server
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._by_chat, f)
+        os.replace(tmp, self.path)
+        self._stamp = self._file_stamp()
+
+    # ---- чтение ----
+    def accounts(self, chat_id) -> List[dict]:
+        """Ящики одного чата: [{"email": ..., "password": ...}]."""
+        with self._lock:
+            self._refresh()
+            return [dict(acc) for acc in self._by_chat.get(str(chat_id), ())]
+
+    def all_accounts(self) -> List[Tuple[str, dict]]:
+        """Все ящики: [(chat_id, аккаунт), ...] — снимок для проверки почты."""
+        with self._lock:
+            self._refresh()
+            return [(chat_id, acc) for chat_id, accounts in self._by_chat.items() for acc in accounts]
+
+    def on_server(self, server: str) -> List[Tuple[str, str]]:
+        """Ящики на одном IMAP-сервере: [(chat_id, email), ...]."""
+        with self._lock:
+            self._refresh()
+            return sorted(self._by_server.get(server, ()))
+
+    def servers(self) -> Dict[str, int]:
+        """Сколько ящиков на каждом IMAP-сервере."""
+        with self._lock:
+            self._refresh()
+            return {server: len(keys) for server, keys in self._by_server.items()}
+
+    # ---- запись ----
+    def save(self, chat_id, email_addr: str, password: str):
+        """Добавить ящик чату (или заменить пароль уже подключённого)."""
+        chat_id = str(chat_id)
+        with self._lock:
+            self._refresh()
+            accounts = [acc for acc in self._by_chat.get(chat_id, ()) if acc["email"] != email_addr]
+            accounts.append({"email": email_addr, "password": password})
+            self._by_chat[chat_id] = accounts
+            self._by_server.setdefault(self._server_of(email_addr), set()).add((chat_id, email_addr))
+            self._write()
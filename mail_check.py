@@ -1,9 +1,11 @@
 # mail_check.py
+import asyncio
 import imaplib
 import email
-import os
-import json
 import logging
+import lanes  # фоновая полоса: свой пул потоков и свой Bot для оповещений
+import send_queue as SQ
+from mail_accounts import AccountRegistry
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     CallbackQueryHandler, MessageHandler, filters,
@@ -24,32 +26,12 @@ user_last_uid = {}  # {chat_id: {email: last_uid}}
 
 # === Вспомогательные функции ===
 def load_accounts(chat_id):
-    """Загрузка сохранённых аккаунтов"""
-    if not os.path.exists(ACCOUNTS_FILE):
-        return []
-    try:
-        with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get(str(chat_id), [])
-    except Exception as e:
-        logger.error(f"Ошибка чтения {ACCOUNTS_FILE}: {e}")
-        return []
+    """Загрузка сохранённых аккаунтов (из памяти; файл перечитывается, только если изменился)"""
+    return _accounts.accounts(chat_id)
 
 def save_account(chat_id, email_addr, password):
-    """Сохранение нового аккаунта"""
-    data = {}
-    if os.path.exists(ACCOUNTS_FILE):
-        try:
-            with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except:
-            pass
-    chat_accounts = data.get(str(chat_id), [])
-    chat_accounts = [acc for acc in chat_accounts if acc["email"] != email_addr]
-    chat_accounts.append({"email": email_addr, "password": password})
-    data[str(chat_id)] = chat_accounts
-    with open(ACCOUNTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    """Сохранение нового аккаунта (память + атомарная запись файла)"""
+    _accounts.save(chat_id, email_addr, password)
 
 def guess_imap_server(email_addr):
     """Определяет IMAP-сервер по домену"""
@@ -64,6 +46,8 @@ def guess_imap_server(email_addr):
         return "imap-mail.outlook.com"
     return f"imap.{domain}"
 
+_accounts = AccountRegistry(ACCOUNTS_FILE, guess_imap_server)
+
 def parse_email_message(raw_message):
     """Извлекает имя и фамилию отправителя"""
     msg = email.message_from_bytes(raw_message)
@@ -164,49 +148,56 @@ async def mail_select_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 async def mail_checker_task(context: ContextTypes.DEFAULT_TYPE):
     """Проверяет новые письма и отправляет уведомления"""
     bot = context.bot
-    if not os.path.exists(ACCOUNTS_FILE):
-        return
+    # снимок реестра: без чтения файла, пока он не изменился
+    accounts = _accounts.all_accounts()
+
+    async def _check(chat_id, acc):
+        email_addr = acc["email"]
+        prev_uid = user_last_uid.get(chat_id, {}).get(email_addr)
+        try:
+            # IMAP блокирующий — в пуле фоновой полосы, а не в цикле событий
+            last_uid = await lanes.run_bulk(_check_account, email_addr, acc["password"], prev_uid)
+            if last_uid is not None:
+                await SQ.send_message(
+                    bot, int(chat_id),
+                    f"📩 На вашу корпоративную почту пришло новое сообщение. Посмотри, вдруг там что-то важное!",
+                    priority=SQ.PRIORITY_BULK,
+                )
+                user_last_uid.setdefault(chat_id, {})[email_addr] = last_uid
+        except Exception as e:
+            logger.error(f"Ошибка при проверке {email_addr}: {e}")
+
+    await asyncio.gather(*(_check(chat_id, acc) for chat_id, acc in accounts))
+
+
+def _check_account(email_addr, password, prev_uid):
+    """UID нового последнего письма или None, если нового нет."""
+    server = guess_imap_server(email_addr)
+    imap = imaplib.IMAP4_SSL(server)
     try:
-        with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except:
-        return
-
-    for chat_id, accounts in data.items():
-        for acc in accounts:
-            email_addr = acc["email"]
-            password = acc["password"]
-            server = guess_imap_server(email_addr)
-            try:
-                imap = imaplib.IMAP4_SSL(server)
-                imap.login(email_addr, password)
-                imap.select("INBOX")
-                status, data_uids = imap.search(None, "ALL")
-                if status != "OK":
-                    imap.logout()
-                    continue
-                uids = data_uids[0].split()
-                if not uids:
-                    imap.logout()
-                    continue
-
-                last_uid = uids[-1]
-                prev_uid = user_last_uid.get(chat_id, {}).get(email_addr)
-
-                if prev_uid != last_uid:
-                    status, msg_data = imap.fetch(last_uid, "(RFC822)")
-                    if status == "OK":
-                        raw_email = msg_data[0][1]
-                        first_name, last_name, from_email = parse_email_message(raw_email)
-                        await bot.send_message(
-                            chat_id=int(chat_id),
-                            text=f"📩 На вашу корпоративную почту пришло новое сообщение. Посмотри, вдруг там что-то важное!"
-                        )
-                        user_last_uid.setdefault(chat_id, {})[email_addr] = last_uid
-                imap.logout()
-            except Exception as e:
-                logger.error(f"Ошибка при проверке {email_addr}: {e}")
-                continue
+        imap.login(email_addr, password)
+        imap.select("INBOX")
+        status, data_uids = imap.search(None, "ALL")
+        if status != "OK":
+            return None
+        uids = data_uids[0].split()
+        if not uids:
+            return None
+
+        last_uid = uids[-1]
+        if prev_uid == last_uid:
+            return None
+        status, msg_data = imap.fetch(last_uid, "(RFC822)")
+        if status != "OK":
+            return None
+        raw_email = msg_data[0][1]
+        first_name, last_name, from_email = parse_email_message(raw_email)
+        return last_uid
+    finally:
+        try:
+            imap.logout()
+        except Exception:
+            pass
 
 
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -6,10 +6,15 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ContextTypes, ConversationHandler, Defaults, JobQueue
 )
-from telegram.request import HTTPXRequest
-from schedule_groups import build_schedule_groups_conv, start as groups_start
+from schedule_groups import build_schedule_groups_conv, start as groups_start, warm_popular_groups
 from schedule import schedule_menu, schedule_callback
 import teachers_schedule as TS
+import timetable_cache as TC
+import timetable_store as TStore
+import group_directory as GD
+import lanes
+import delivery_ledger as DL
+import user_store as US
 from settings import add_settings_handlers, register_notification_jobs
 from homework import *
 from mail_check import add_mail_handlers, mail_checker_task, start_mail
@@ -199,22 +204,25 @@ def reset_selection(context):
     for k in ("group", "group_candidates", "teacher_id", "teacher_name", "teachers_map"):
         context.user_data.pop(k, None)
 
+async def on_shutdown(application):
+    """post_shutdown: дописать отложенные изменения настроек, закрыть фоновую полосу."""
+    await US.flush_on_shutdown(application)
+    await lanes.stop_bulk_lane(application)
+
 def main():
     for var in ("HTTP_PROXY","HTTPS_PROXY","ALL_PROXY","http_proxy","https_proxy","all_proxy"):
         os.environ.pop(var, None)
 
-    request = HTTPXRequest(
-        read_timeout=30.0,
-        write_timeout=30.0,
-        connect_timeout=30.0,
-        pool_timeout=30.0,
-    )
+    # интерактивная полоса — свой пул соединений; рассылки идут через отдельный Bot (lanes.py)
+    request = lanes.interactive_request()
 
     app = (
         ApplicationBuilder()
         .token(open('token.txt').readline())
         .request(request)
         .defaults(Defaults(parse_mode=ParseMode.HTML))
+        .post_init(lanes.start_bulk_lane)
+        .post_shutdown(on_shutdown)
         .build()
     )
 
@@ -269,9 +277,19 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     app.add_error_handler(on_error)
 
+    # локальная копия расписаний: после рестарта кеш не пустой
+    TStore.init_db()
+    DL.init_db()
+    US.init_db()  # при первом запуске переносит favorites.json
+    TC.warm_from_store()
+
     add_settings_handlers(app)
     register_notification_jobs(app)
     app.job_queue.run_repeating(mail_checker_task, interval=60, first=5)
+    GD.load()
+    app.job_queue.run_repeating(GD.refresh_job, interval=GD.REFRESH_INTERVAL, first=60)
+    app.job_queue.run_repeating(warm_popular_groups, interval=TC.FRESH_TTL, first=30)
+    app.job_queue.run_repeating(TS.refresh_teacher_directory, interval=TS.TEACHERS_REFRESH_INTERVAL, first=120)
 
     print("✅ Бот запущен (polling)…")
     app.run_polling(
@@ -0,0 +1,212 @@
+# notify_scheduler.py
+"""
+Планировщик уведомлений по минутным корзинам.
+
+Вместо задачи JobQueue на каждого пользователя и каждое время уведомления
+здесь один индекс «HH:MM -> пользователи» и одна задача, которая раз в минуту
+забирает корзину текущей минуты и отдаёт её целиком одним пакетом.
+Добавить или убрать время уведомления — O(1), число задач в JobQueue не
+зависит от числа пользователей.
+
+Та же задача заранее вызывает прогрев для корзины через warmup_lead минут.
+
+Последняя обработанная минута сохраняется в файл. После перезапуска первый
+тик досылает слоты, пропущенные за время простоя (если простой не дольше
+grace_min минут), — одним пакетом, слот за слотом.
+"""
+import json
+import logging
+import os
+import time
+import zoneinfo
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+TICK_JOB_NAME = "notify_tick"
+MAX_CATCHUP_MIN = 5   # если тик опоздал — досылаем пропущенные минуты, но не больше стольких
+
+Dispatch = Callable[..., Awaitable[None]]   # fn(context, slot, user_ids, day=дата слота)
+
+
+def _minute(dt: datetime) -> str:
+    return dt.strftime("%H:%M")
+
+
+class NotificationScheduler:
+    """Индекс подписок по времени и минутный тик."""
+
+    def __init__(self, dispatch: Dispatch, warmup: Optional[Dispatch] = None, warmup_lead: int = 0,
+                 state_path: Optional[str] = None, grace_min: int = 0):
+        self._dispatch = dispatch
+        self._warmup = warmup
+        self._warmup_lead = warmup_lead
+        self._state_path = state_path
+        self._grace_min = grace_min
+        self._buckets: Dict[str, Set[int]] = {}     # "HH:MM" -> user ids
+        self._by_user: Dict[int, Set[str]] = {}     # user id -> "HH:MM"
+        self._last_tick: Optional[datetime] = None
+        self._catchup_limit = MAX_CATCHUP_MIN
+        self.tz = zoneinfo.ZoneInfo("Europe/Moscow")
+
+    # ---- индекс ----
+    def add(self, user_id: int, slot: str):
+        self._buckets.setdefault(slot, set()).add(user_id)
+        self._by_user.setdefault(user_id, set()).add(slot)
+
+    def remove(self, user_id: int, slot: str):
+        users = self._buckets.get(slot)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._buckets[slot]
+        slots = self._by_user.get(user_id)
+        if slots is not None:
+            slots.discard(slot)
+            if not slots:
+                del self._by_user[user_id]
+
+    def set_user_slots(self, user_id: int, slots: Iterable[str]):
+        """Привести время уведомлений пользователя к slots (меняется только разница)."""
+        new = set(slots)
+        old = set(self._by_user.get(user_id, ()))
+        for slot in old - new:
+            self.remove(user_id, slot)
+        for slot in new - old:
+            self.add(user_id, slot)
+
+    def clear_user(self, user_id: int):
+        self.set_user_slots(user_id, ())
+
+    def clear(self):
+        self._buckets.clear()
+        self._by_user.clear()
+
+    def replace_all(self, subscriptions: Dict[int, Iterable[str]]):
+        """Заменить весь индекс разом: {user_id: ["HH:MM", ...]} (при старте)."""
+        buckets: Dict[str, Set[int]] = {}
+        by_user: Dict[int, Set[str]] = {}
+        for user_id, slots in subscriptions.items():
+            slots = set(slots)
+            if not slots:
+                continue
+            by_user[user_id] = slots
+            for slot in slots:
+                buckets.setdefault(slot, set()).add(user_id)
+        self._buckets, self._by_user = buckets, by_user
+
+    def users_at(self, slot: str) -> List[int]:
+        return sorted(self._buckets.get(slot, ()))
+
+    def user_slots(self, user_id: int) -> List[str]:
+        return sorted(self._by_user.get(user_id, ()))
+
+    def slots(self) -> List[str]:
+        return sorted(self._buckets)
+
+    def stats(self) -> dict:
+        return {
+            "slots": len(self._buckets),
+            "users": len(self._by_user),
+            "subscriptions": sum(len(u) for u in self._buckets.values()),
+        }
+
+    # ---- тик ----
+    def start(self, job_queue):
+        """Запустить минутный тик (повторный вызов не плодит задачи)."""
+        tz = getattr(job_queue, "timezone", None)
+        if tz is not None:
+            self.tz = tz
+        if job_queue.get_jobs_by_name(TICK_JOB_NAME):
+            return
+        now = datetime.now(self.tz)
+        self._restore_last_tick(now)
+        first = 60 - now.second - now.microsecond / 1e6   # ровно в начале следующей минуты
+        job_queue.run_repeating(self.tick, interval=60, first=first, name=TICK_JOB_NAME)
+
+    # ---- состояние между перезапусками ----
+    def _restore_last_tick(self, now: datetime):
+        """Последняя обработанная до перезапуска минута — с неё первый тик и продолжит."""
+        if not self._state_path or not self._grace_min or not os.path.exists(self._state_path):
+            return
+        try:
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                last = datetime.fromisoformat(json.load(f)["last_tick"])
+        except Exception as e:
+            logger.warning("Не удалось прочитать %s: %s", self._state_path, e)
+            return
+        if last.tzinfo is None:
+            last = last.replace(tzinfo=self.tz)
+        missed = (now - last).total_seconds() / 60
+        if missed > self._grace_min:
+            logger.warning("Простой %.0f мин дольше %d мин — пропущенные уведомления не досылаем",
+                           missed, self._grace_min)
+            return
+        self._last_tick = last
+        self._catchup_limit = max(MAX_CATCHUP_MIN, self._grace_min + 1)
+
+    def _save_last_tick(self):
+        if not self._state_path or self._last_tick is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._state_path) or ".", exist_ok=True)
+            tmp = self._state_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"last_tick": self._last_tick.isoformat()}, f)
+            os.replace(tmp, self._state_path)
+        except Exception as e:
+            logger.warning("Не удалось сохранить %s: %s", self._state_path, e)
+
+    def _due_minutes(self, now: datetime) -> List[datetime]:
+        cur = now.replace(second=0, microsecond=0)
+        if self._last_tick is None:
+            due = [cur]
+        elif cur <= self._last_tick:
+            due = []
+        else:
+            gap = int((cur - self._last_tick).total_seconds() // 60)
+            if gap > self._catchup_limit:
+                logger.warning("Тик уведомлений опоздал на %d мин, пропущенное не досылаем", gap)
+                due = [cur]
+            else:
+                due = [self._last_tick + timedelta(minutes=i) for i in range(1, gap + 1)]
+        self._last_tick = cur
+        self._catchup_limit = MAX_CATCHUP_MIN
+        return due
+
+    async def tick(self, context):
+        due = self._due_minutes(datetime.now(self.tz))
+        self._save_last_tick()
+        if not due:
+            return
+
+        # прогрев — только для текущей минуты: для прошедших он уже не нужен
+        if self._warmup is not None:
+            ahead = due[-1] + timedelta(minutes=self._warmup_lead)
+            users = self.users_at(_minute(ahead))
+            if users:
+                context.application.create_task(
+                    self._run(self._warmup, context, _minute(ahead), users, ahead.date()))
+
+        batch = [(_minute(m), self.users_at(_minute(m)), m.date()) for m in due]
+        batch = [(slot, users, day) for slot, users, day in batch if users]
+        if len(due) > 1 and batch:
+            logger.warning("Досылаем пропущенные слоты: %s", ", ".join(slot for slot, _, _ in batch))
+        # пакеты запускаются отдельной задачей: длинная рассылка не задерживает следующий тик;
+        # пропущенные слоты идут одной задачей по очереди, а не всплеском параллельных
+        if batch:
+            context.application.create_task(self._run_batch(context, batch))
+
+    async def _run_batch(self, context, batch):
+        for slot, users, day in batch:
+            await self._run(self._dispatch, context, slot, users, day)
+
+    async def _run(self, fn: Dispatch, context, slot: str, users: List[int], day):
+        started = time.monotonic()
+        try:
+            await fn(context, slot, users, day=day)
+        except Exception:
+            logger.exception("Ошибка обработки слота %s (%s)", slot, getattr(fn, "__name__", fn))
+        logger.info("Слот %s (%s): %d польз. за %.2f с",
+                    slot, getattr(fn, "__name__", fn), len(users), time.monotonic() - started)
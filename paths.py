@@ -0,0 +1,11 @@
+# paths.py
+"""
+Где лежат файлы данных бота.
+
+Пути считаются от каталога с кодом, а не от текущего каталога процесса:
+бот, запущенный из другого места (systemd, cron, IDE), найдёт те же базы.
+"""
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
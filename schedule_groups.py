@@ -1,13 +1,12 @@
+import asyncio
 import re
 import sys
 import logging
-import os, json, threading
-_FAV_FILE = os.path.join(os.path.dirname(__file__), "favorites.json")
-_FAV_LOCK = threading.Lock()
+import os, json
 from datetime import datetime, timedelta
 from typing import Tuple, Dict, List, Any, Optional
 from collections import defaultdict
-from homework import send_homework_for_date
+from homework import send_homework_for_date, format_homework_for_date
 ##PINGUIN
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
@@ -19,10 +18,24 @@ from telegram.ext import (
     CommandHandler,
     filters,
 )
-from fa_api import FaAPI  # библиотека расписаний
+import fa_client as FC  # вызовы FaAPI (склейка одинаковых запросов)
+import send_queue as SQ  # исходящие сообщения с учётом лимитов Telegram
+import group_directory as GD  # локальный справочник групп
+import timetable_cache as TC  # общий кеш расписаний групп
+import digest_cache as DC  # готовые дайджесты дня (расписание + ДЗ)
+import lanes  # блокирующие вызовы: из фоновой работы — в пул фоновой полосы
+import user_store as US  # настройки пользователей (избранные группы, уведомления)
+from timetable_store import as_of_note
 
 _RINGS_DEFAULT = ["08:30","10:15","12:00","13:50","15:35","17:20","19:05"]
 
+# Расписание дня, ДЗ и кнопки — одним сообщением вместо трёх (см. send_day_digest)
+MERGE_DAY_MESSAGES = os.getenv("MERGE_DAY_MESSAGES", "1") != "0"
+TG_MESSAGE_LIMIT = 4096
+
+# Сколько самых популярных групп (по числу подписчиков) держать в кеше прогретыми
+POPULAR_GROUPS_WARM = int(os.getenv("POPULAR_GROUPS_WARM", "20"))
+
 
 WELCOME_TEXT_MAIN = (
     "Привет! 👋\n"
@@ -46,7 +59,6 @@ DATE_INPUT_RE = re.compile(r"^(\d{2})[.](\d{2})[.](\d{4})$")  # DD.MM.YYYY
 DATE_FMT_API = "%Y.%m.%d"
 DATE_FMT_HUMAN = "%d.%m.%Y"
 
-fa = FaAPI()
 
 logger = logging.getLogger("fa-bot")
 
@@ -64,16 +76,6 @@ _RU_WEEKDAY_NOM = {
 }
 _RU_WEEKDAY_SHORT = {0: "Пн", 1: "Вт", 2: "Ср", 3: "Чт", 4: "Пт", 5: "Сб", 6: "Вс"}
 
-def _norm_api_date_key(s: str) -> Optional[str]:
-    if not isinstance(s, str):
-        return None
-    s = s.strip()
-    m = re.match(r"^(\d{4})[.\-\/](\d{2})[.\-\/](\d{2})$", s)
-    if not m:
-        return None
-    y, mo, d = m.groups()
-    return f"{y}.{mo}.{d}"
-
 def _to_api_date(d: datetime) -> str:
     return d.strftime(DATE_FMT_API)
 
@@ -85,89 +87,42 @@ def _week_bounds(dt: datetime) -> Tuple[datetime, datetime]:
     end = start + timedelta(days=6)
     return start, end
 
-def _fav_load():
-    with _FAV_LOCK:
-        if not os.path.exists(_FAV_FILE):
-            return {}
-        try:
-            with open(_FAV_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f)
-                return d if isinstance(d, dict) else {}
-        except Exception:
-            return {}
-
-def _fav_save(d):
-    with _FAV_LOCK:
-        tmp = _FAV_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(d, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, _FAV_FILE)
-
-def _normalize_legacy_user_entry(entry):
-    """
-    Миграция: если раньше хранилась одна группа в виде dict, превращаем в список.
-    """
-    if not isinstance(entry, dict):
-        return {"groups": []}
-    groups = entry.get("groups")
-    single = entry.get("group")
-    if isinstance(groups, list):
-        return {"groups": [g for g in groups if isinstance(g, dict) and g.get("id")]}
-    if isinstance(single, dict) and single.get("id"):
-        return {"groups": [ {"id": str(single["id"]), "name": str(single.get("name") or single.get("title") or single.get("group") or single["id"])} ]}
-    return {"groups": []}
+def _sync_notifications(user_id, entry):
+    """Избранное изменилось — обновляем уведомления только этого пользователя."""
+    from settings import apply_notify_defaults, sync_user_notifications
+    apply_notify_defaults(entry)
+    sync_user_notifications(user_id, entry)
 
 def get_fav_groups(user_id: int):
     """
     Возвращает список избранных групп пользователя: [{"id": "...", "name": "..."}].
-    Гарантирует миграцию из старого формата.
+    Старый формат переносится один раз при старте (user_store.init_db).
+    Только чтение из памяти — диск не трогается.
     """
-    d = _fav_load()
-    key = str(user_id)
-    entry = _normalize_legacy_user_entry(d.get(key, {}))
-    # если была миграция — сохраним
-    d[key] = entry
-    _fav_save(d)
-    return entry["groups"]
+    return US.fav_groups(user_id)
 
 def is_fav_group(user_id: int, gid: str) -> bool:
-    gid = str(gid)
-    return any(str(g.get("id")) == gid for g in get_fav_groups(user_id))
+    return US.is_fav_group(user_id, gid)
 
 def add_fav_group(user_id: int, gid: str, gname: str):
-    d = _fav_load()
-    key = str(user_id)
-    entry = _normalize_legacy_user_entry(d.get(key, {}))
-    # уникальность по id
     gid = str(gid)
-    if not any(str(g.get("id")) == gid for g in entry["groups"]):
-        entry["groups"].append({"id": gid, "name": str(gname)})
-    d[key] = entry
-    _fav_save(d)
+
+    def _add(entry):
+        # уникальность по id
+        if not any(str(g.get("id")) == gid for g in entry["groups"]):
+            entry["groups"].append({"id": gid, "name": str(gname)})
+        _sync_notifications(user_id, entry)
+
+    US.update_user(user_id, _add)
 
 def remove_fav_group(user_id: int, gid: str):
-    d = _fav_load()
-    key = str(user_id)
-    entry = _normalize_legacy_user_entry(d.get(key, {}))
     gid = str(gid)
-    entry["groups"] = [g for g in entry["groups"] if str(g.get("id")) != gid]
-    d[key] = entry
-    _fav_save(d)
-
-def _lesson_date_api(lesson: dict) -> str:
-    raw = (
-        lesson.get("date") or lesson.get("day") or lesson.get("date_str")
-        or lesson.get("lesson_date") or lesson.get("start") or lesson.get("datetime")
-    )
-    if isinstance(raw, str) and raw:
-        s = raw.strip()
-        if re.match(r"^\d{4}\.\d{2}\.\d{2}$", s):
-            return s
-        m = re.match(r"^(\d{4})[-/](\d{2})[-/](\d{2})", s)
-        if m:
-            y, mo, d = m.groups()
-            return f"{y}.{mo}.{d}"
-    return datetime.now().strftime("%Y.%m.%d")
+
+    def _remove(entry):
+        entry["groups"] = [g for g in entry["groups"] if str(g.get("id")) != gid]
+        _sync_notifications(user_id, entry)
+
+    US.update_user(user_id, _remove)
 
 def _first_str(*vals) -> str:
     """Вернёт первый непустой str из набора значений."""
@@ -556,32 +511,6 @@ def _extract_lesson_fields(lesson: dict) -> dict:
         "is_online": is_online,
     }
 
-def _group_by_date(data) -> Dict[str, List[dict]]:
-    grouped: Dict[str, List[dict]] = {}
-    if isinstance(data, dict):
-        for k, v in data.items():
-            k2 = _norm_api_date_key(k)
-            if k2 is None:
-                continue
-            grouped.setdefault(k2, []).extend(list(v or []))
-        return grouped
-    if isinstance(data, list):
-        for les in data:
-            ds = _lesson_date_api(les)
-            grouped.setdefault(ds, []).append(les)
-    return grouped
-
-def _filter_lessons_by_date(data, target_api_date: str):
-    if isinstance(data, dict):
-        for k, v in data.items():
-            k2 = _norm_api_date_key(k)
-            if k2 == target_api_date:
-                return list(v or [])
-        return []
-    if isinstance(data, list):
-        return [les for les in data if _lesson_date_api(les) == target_api_date]
-    return []
-
 def _fmt_day(date_str: str, lessons: List[Dict[str, Any]], group_name_for_header: Optional[str] = None) -> str:
     d = datetime.strptime(date_str, DATE_FMT_API)
     dow_nom = _RU_WEEKDAY_NOM[d.weekday()]
@@ -674,6 +603,83 @@ def _fmt_day(date_str: str, lessons: List[Dict[str, Any]], group_name_for_header
 
     return "\n".join(lines).rstrip()
 
+async def _render_digest(gid: str, ds: str, gname: str) -> DC.Digest:
+    """Расписание дня и ДЗ группы одним дайджестом (см. digest_cache)."""
+    days = await TC.group_days(gid, ds, ds)
+    text = _fmt_day(ds, days[ds], gname) + as_of_note(days.as_of)
+    date_str = datetime.strptime(ds, "%Y.%m.%d").strftime("%d.%m.%Y")
+    try:
+        hw_text = await lanes.run_io(format_homework_for_date, gname, date_str)
+    except Exception as e:
+        logger.warning("Не удалось получить ДЗ для %s: %s", gname, e)
+        hw_text = None
+    return DC.Digest(text, hw_text, cacheable=days.as_of is None)
+
+async def get_day_digest(gid, ds: str, gname: str) -> DC.Digest:
+    """Готовый дайджест (группа, дата): из памяти, а если нет — собрать и запомнить."""
+    return await DC.get(gid, ds, gname, _render_digest)
+
+async def warm_popular_groups(context: ContextTypes.DEFAULT_TYPE):
+    """Задача JobQueue: сегодня и завтра самых популярных групп — в кеше до первых нажатий."""
+    if not FC.source_available():
+        return
+    today = datetime.now()
+    date_begin, date_end = _to_api_date(today), _to_api_date(today + timedelta(days=1))
+    groups = US.top_groups(POPULAR_GROUPS_WARM)
+    with lanes.background():
+        results = await asyncio.gather(
+            *(TC.group_days(gid, date_begin, date_end) for gid, _, _ in groups), return_exceptions=True
+        )
+    failed = sum(1 for r in results if isinstance(r, Exception))
+    logger.info("Прогрев популярных групп: %d/%d", len(groups) - failed, len(groups))
+
+def _split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Разбить текст на части не длиннее limit — по строкам, длинную строку — по символам."""
+    if len(text) <= limit:
+        return [text]
+    parts, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                parts.append(cur)
+                cur = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{cur}\n{line}" if cur else line
+        if len(candidate) > limit:
+            parts.append(cur)
+            cur = line
+        else:
+            cur = candidate
+    if cur:
+        parts.append(cur)
+    return parts
+
+async def send_day_digest(bot, chat_id, digest: DC.Digest, reply_markup=None, priority: int = SQ.PRIORITY_HIGH):
+    """
+    Отправить дайджест дня. При MERGE_DAY_MESSAGES расписание, ДЗ и кнопки уходят
+    одним сообщением (несколькими — только если длиннее лимита Telegram);
+    иначе — как раньше: расписание, ДЗ и сообщение с кнопками отдельно.
+    """
+    if MERGE_DAY_MESSAGES:
+        text = digest.schedule + (f"\n\n{digest.homework}" if digest.homework else "")
+        parts = _split_message(text)
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            await SQ.send_message(bot, chat_id, part, priority=priority, parse_mode=ParseMode.HTML,
+                                  reply_markup=reply_markup if last else None)
+        return
+
+    await SQ.send_message(bot, chat_id, digest.schedule, priority=priority, parse_mode=ParseMode.HTML)
+    if digest.homework:
+        try:
+            await SQ.send_message(bot, chat_id, digest.homework, priority=priority, parse_mode=ParseMode.HTML)
+        except Exception:
+            logger.warning("Не удалось отправить домашку, пропускаю без вывода")
+    if reply_markup is not None:
+        await SQ.send_message(bot, chat_id, "Выберите дальнейшее действие:",
+                              priority=priority, reply_markup=reply_markup)
+
 def _group_id(g: Dict[str, Any]):
     return g.get("id") or g.get("group_id") or g.get("gid") or g.get("uuid") or g.get("_id")
 
@@ -779,12 +785,21 @@ async def ask_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not query_text:
         await update.message.reply_text("Введите название группы ещё раз.")
         return ASK_GROUP
-    try:
-        groups = fa.search_group(query_text)
-    except Exception as e:
-        logger.exception("Ошибка поиска группы: %s", e)
-        await update.message.reply_text("Произошла ошибка при поиске. Попробуйте ещё раз.")
-        return ASK_GROUP
+    # точное совпадение в локальном справочнике — без источника;
+    # справочник неполный, поэтому при префиксе/опечатке всё равно спрашиваем источник
+    groups, match = GD.lookup(query_text)
+    if match != GD.EXACT or not groups:
+        try:
+            found = await FC.search_group(query_text)
+        except Exception as e:
+            if not (groups and FC.is_source_down(e)):
+                logger.exception("Ошибка поиска группы: %s", e)
+                await update.message.reply_text("Произошла ошибка при поиске. Попробуйте ещё раз.")
+                return ASK_GROUP
+            # источник недоступен — показываем похожие из справочника, выбирает пользователь
+        else:
+            await asyncio.to_thread(GD.remember, found)   # запись справочника — не в цикле событий
+            groups, match = found, None
 
     if not groups:
         await update.message.reply_text("Мы не нашли такую группу. Пожалуйста, введите название ещё раз.")
@@ -792,7 +807,10 @@ async def ask_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     query_l = query_text.lower()
     exact = [g for g in groups if _group_name(g).strip().lower() == query_l]
-    chosen = exact[0] if len(exact) == 1 else (groups[0] if len(groups) == 1 else None)
+    if match in (GD.PREFIX, GD.FUZZY):
+        chosen = None  # неточные варианты из справочника — пусть пользователь выберет сам
+    else:
+        chosen = exact[0] if len(exact) == 1 else (groups[0] if len(groups) == 1 else None)
     if chosen:
         context.user_data["group"] = chosen
         await update.message.reply_text(
@@ -918,30 +936,10 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         ds = _to_api_date(d)
         try:
             chat_id = update.effective_chat.id
-            raw = fa.timetable_group(gid)
-            lessons = _filter_lessons_by_date(raw, ds)
-            text = _fmt_day(ds, lessons, gname)
+            digest = await get_day_digest(gid, ds, gname)
 
-            # 1️⃣ Отправляем расписание
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=ParseMode.HTML
-            )
-
-            # 2️⃣ Пробуем отправить домашку (без вывода ошибок)
-            date_str = _to_human_date(d)
-            try:
-                await send_homework_for_date(update, context, gname, date_str)
-            except Exception:
-                logger.warning("Не удалось получить домашку (today), пропускаю без вывода")
-
-            # 3️⃣ Сообщение с кнопками
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Выберите дальнейшее действие:",
-                reply_markup=_kb_ranges(gid, gname, user_id)
-            )
+            # Расписание, домашка и кнопки (одним сообщением, если MERGE_DAY_MESSAGES)
+            await send_day_digest(context.bot, chat_id, digest, reply_markup=_kb_ranges(gid, gname, user_id))
 
         except Exception as e:
             logger.exception("Ошибка timetable today: %s", e)
@@ -957,33 +955,10 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         ds = _to_api_date(d)
         try:
             chat_id = update.effective_chat.id
-            start = _to_api_date(today)
-            end = _to_api_date(today + timedelta(days=1))
-            raw = fa.timetable_group(gid, start, end)
-            grouped = _group_by_date(raw)
-            lessons = grouped.get(ds, [])
-            text = _fmt_day(ds, lessons, gname)
-
-            # 1️⃣ Отправляем расписание
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=ParseMode.HTML
-            )
-
-            # 2️⃣ Пробуем отправить домашку (без вывода ошибок)
-            date_str = _to_human_date(d)
-            try:
-                await send_homework_for_date(update, context, gname, date_str)
-            except Exception:
-                logger.warning("Не удалось получить домашку (tomorrow), пропускаю без вывода")
+            digest = await get_day_digest(gid, ds, gname)
 
-            # 3️⃣ Сообщение с кнопками
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Выберите дальнейшее действие:",
-                reply_markup=_kb_ranges(gid, gname, user_id)
-            )
+            # Расписание, домашка и кнопки (одним сообщением, если MERGE_DAY_MESSAGES)
+            await send_day_digest(context.bot, chat_id, digest, reply_markup=_kb_ranges(gid, gname, user_id))
 
         except Exception as e:
             logger.exception("Ошибка timetable tomorrow: %s", e)
@@ -997,15 +972,15 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         ws, we = _week_bounds(today)
         ds, de = _to_api_date(ws), _to_api_date(we)
         try:
-            raw = fa.timetable_group(gid, ds, de)
-            grouped = _group_by_date(raw)  # {'YYYY.MM.DD': [lessons]}
+            grouped = await TC.group_days(gid, ds, de)  # {'YYYY.MM.DD': [lessons]}, каждый день недели
         except Exception as e:
             logger.exception("Ошибка timetable this_week: %s", e)
             await query.edit_message_text("Источник временно недоступен. Попробуйте позже.", reply_markup=_kb_ranges())
             return CHOOSE_RANGE
 
         await query.edit_message_text(
-            f"<b>Расписание для {gname} на неделю ({_to_human_date(ws)}–{_to_human_date(we)})</b>\n\nОтправляю по дням ниже ⬇️",
+            f"<b>Расписание для {gname} на неделю ({_to_human_date(ws)}–{_to_human_date(we)})</b>\n\nОтправляю по дням ниже ⬇️"
+            + as_of_note(grouped.as_of),
             parse_mode=ParseMode.HTML,
         )
 
@@ -1017,28 +992,21 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             d = ws + timedelta(days=i)
             ds_day = _to_api_date(d)
 
-            lessons_day = grouped.get(ds_day, None)
-            if lessons_day is None:
-                # если пакет не дал этот день — добираем точечно
-                try:
-                    raw_day = fa.timetable_group(gid, ds_day, ds_day)
-                    lessons_day = _filter_lessons_by_date(raw_day, ds_day)
-                except Exception:
-                    lessons_day = []
+            lessons_day = grouped.get(ds_day) or []
 
             if lessons_day:
                 text_day = _fmt_day(ds_day, lessons_day, gname)
-                await context.bot.send_message(chat_id=chat_id, text=text_day, parse_mode=ParseMode.HTML)
+                await SQ.send_message(context.bot, chat_id, text_day, priority=SQ.PRIORITY_HIGH, parse_mode=ParseMode.HTML)
                 date_str = _to_human_date(d)
                 await send_homework_for_date(update, context, gname, date_str)
                 sent_any = True
 
         if not sent_any:
-            await context.bot.send_message(chat_id=chat_id, text="Нет занятий на этой неделе.")
+            await SQ.send_message(context.bot, chat_id, "Нет занятий на этой неделе.", priority=SQ.PRIORITY_HIGH)
 
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Выберите период:",
+        await SQ.send_message(
+            context.bot, chat_id, "Выберите период:",
+            priority=SQ.PRIORITY_HIGH,
             reply_markup=_kb_ranges(gid, gname, user_id)
         )
         return CHOOSE_RANGE
@@ -1046,15 +1014,15 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     ws, we = _week_bounds(today + timedelta(days=7))
     ds, de = _to_api_date(ws), _to_api_date(we)
     try:
-        raw = fa.timetable_group(gid, ds, de)
-        grouped = _group_by_date(raw)
+        grouped = await TC.group_days(gid, ds, de)
     except Exception as e:
         logger.exception("Ошибка timetable next_week: %s", e)
         await query.edit_message_text("Источник временно недоступен. Попробуйте позже.", reply_markup=_kb_ranges())
         return CHOOSE_RANGE
 
     await query.edit_message_text(
-        f"<b>Расписание для {gname} на следующую неделю ({_to_human_date(ws)}–{_to_human_date(we)})</b>\n\nОтправляю по дням ниже ⬇️",
+        f"<b>Расписание для {gname} на следующую неделю ({_to_human_date(ws)}–{_to_human_date(we)})</b>\n\nОтправляю по дням ниже ⬇️"
+        + as_of_note(grouped.as_of),
         parse_mode=ParseMode.HTML,
     )
 
@@ -1065,26 +1033,20 @@ async def choose_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         d = ws + timedelta(days=i)
         ds_day = _to_api_date(d)
 
-        lessons_day = grouped.get(ds_day, None)
-        if lessons_day is None:
-            try:
-                raw_day = fa.timetable_group(gid, ds_day, ds_day)
-                lessons_day = _filter_lessons_by_date(raw_day, ds_day)
-            except Exception:
-                lessons_day = []
+        lessons_day = grouped.get(ds_day) or []
 
         if lessons_day:
             text_day = _fmt_day(ds_day, lessons_day, gname)
-            await context.bot.send_message(chat_id=chat_id, text=text_day, parse_mode=ParseMode.HTML)
+            await SQ.send_message(context.bot, chat_id, text_day, priority=SQ.PRIORITY_HIGH, parse_mode=ParseMode.HTML)
             # Домашка на этот день
             date_str = _to_human_date(d)
             await send_homework_for_date(update, context, gname, date_str)
             sent_any = True
 
     if not sent_any:
-        await context.bot.send_message(chat_id=chat_id, text="Нет занятий на следующей неделе.")
+        await SQ.send_message(context.bot, chat_id, "Нет занятий на следующей неделе.", priority=SQ.PRIORITY_HIGH)
 
-    await context.bot.send_message(chat_id=chat_id, text="Выберите период:", reply_markup=_kb_ranges())
+    await SQ.send_message(context.bot, chat_id, "Выберите период:", priority=SQ.PRIORITY_HIGH, reply_markup=_kb_ranges())
     return CHOOSE_RANGE
 
 async def ask_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1113,14 +1075,13 @@ async def ask_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     ds = _to_api_date(d)
     try:
-        raw = fa.timetable_group(gid)
-        lessons = _filter_lessons_by_date(raw, ds)
+        days = await TC.group_days(gid, ds, ds)
     except Exception as e:
         logger.exception("Ошибка timetable by date: %s", e)
         await update.message.reply_text("Источник временно недоступен. Попробуйте позже.")
         return CHOOSE_RANGE
 
-    text = _fmt_day(ds, lessons, gname)
+    text = _fmt_day(ds, days[ds], gname) + as_of_note(days.as_of)
     await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=_kb_ranges())
     date_str = _to_human_date(d)
     await send_homework_for_date(update, context, gname, date_str)
@@ -0,0 +1,333 @@
+# send_queue.py
+"""
+Очередь исходящих сообщений в Telegram.
+
+У Telegram два ограничения: около 30 сообщений в секунду на бота и около
+одного в секунду в один чат (короткие всплески допустимы). Массовые рассылки
+(уведомления, неделя расписания по дням) упираются в них и получают RetryAfter.
+
+Здесь все такие отправки идут через одну очередь:
+  * общий token bucket на SEND_RATE сообщений в секунду;
+  * свой bucket у каждого чата (PER_CHAT_RATE, всплеск до PER_CHAT_BURST),
+    сообщения одного чата уходят строго по порядку;
+  * RetryAfter — ждём сколько сказали (чат и вся очередь) и повторяем;
+  * сетевые ошибки — повтор с экспоненциальной паузой, до SEND_MAX_RETRIES раз,
+    но только если запрос точно не ушёл (не удалось соединиться); таймаут
+    чтения/записи или обрыв ответа — ошибка: сообщение могло дойти, и повтор
+    его бы задвоил;
+  * приоритет у каждого сообщения: ответы пользователю обгоняют рассылку.
+
+Полос две (см. lanes.py): интерактивная и фоновая (PRIORITY_BULK). У каждой
+своя очередь, свой лимит одновременных запросов и свой Bot; общий лимит
+Telegram они делят, но фоновой достаётся не больше BULK_RATE сообщений
+в секунду — остальное всегда свободно для ответов пользователям.
+RetryAfter в фоновой полосе ставит на паузу только её (и чат), а не общий
+лимит — иначе во время рассылки ждали бы и ответы на нажатия.
+
+send_message(...) ждёт, пока сообщение реально уйдёт, и возвращает Message
+(или пробрасывает ошибку), так что вызывающий код не меняет логику.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))           # сообщений в секунду на весь бот
+SEND_BURST = float(os.getenv("SEND_BURST", "5"))
+PER_CHAT_RATE = 1.0                                       # сообщений в секунду в один чат
+PER_CHAT_BURST = 5.0
+SEND_MAX_INFLIGHT = int(os.getenv("SEND_MAX_INFLIGHT", "8"))  # одновременных запросов к Bot API
+BULK_RATE = float(os.getenv("SEND_BULK_RATE", "18"))     # потолок фоновой полосы, сообщений в секунду
+BULK_MAX_INFLIGHT = int(os.getenv("SEND_BULK_INFLIGHT", "4"))
+SEND_MAX_RETRIES = 3
+SEND_BACKOFF = 1.0                                        # сек, удваивается с каждой попыткой
+
+PRIORITY_HIGH = 0      # ответ на действие пользователя
+PRIORITY_NORMAL = 5
+PRIORITY_BULK = 10     # рассылки (и всё, что ниже по приоритету) — фоновая полоса
+
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+
+
+def _never_sent(e: NetworkError) -> bool:
+    """Запрос точно не дошёл до Telegram: соединение так и не установилось (в т.ч. TimedOut от пула/connect)."""
+    return isinstance(e.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def _retry_after_sec(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, sec: float, now: float):
+        """Ничего не выдавать ближайшие sec секунд."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0) - sec * self.rate
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Item:
+    __slots__ = ("call", "future", "priority", "seq", "attempt")
+
+    def __init__(self, call: Callable[[], Awaitable[Any]], future: asyncio.Future, priority: int, seq: int):
+        self.call = call
+        self.future = future
+        self.priority = priority
+        self.seq = seq
+        self.attempt = 0
+
+
+class _Chat:
+    __slots__ = ("items", "bucket", "busy", "version")
+
+    def __init__(self):
+        self.items: List[Tuple[int, int, _Item]] = []   # куча (приоритет, порядок, сообщение)
+        self.bucket = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+        self.busy = False                               # сообщение этого чата уже отправляется
+        self.version = 0                                # отсекаем устаревшие записи в очереди готовых
+
+
+class SendQueue:
+    """Приоритетная очередь отправки с ограничением скорости (общим и по чатам)."""
+
+    def __init__(self, buckets: List[TokenBucket], max_inflight: int,
+                 pause: Optional[List[TokenBucket]] = None):
+        self._buckets = buckets   # общий лимит бота и, для фоновой полосы, её собственный
+        self._pause = buckets if pause is None else pause   # что останавливать по RetryAfter
+        self._chats: Dict[Any, _Chat] = {}
+        self._ready: List[Tuple[int, int, int, Any]] = []     # (приоритет, порядок, версия, чат)
+        self._cooling: List[Tuple[float, int, Any]] = []      # (когда можно, версия, чат)
+        self._seq = itertools.count()
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.retried = 0
+        self.retry_after = 0
+        self.failed = 0
+
+    # ---- постановка в очередь ----
+    def submit(self, chat_id, call: Callable[[], Awaitable[Any]], priority: int = PRIORITY_NORMAL) -> asyncio.Future:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        item = _Item(call, fut, priority, next(self._seq))
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat()
+        heapq.heappush(chat.items, (item.priority, item.seq, item))
+        if not chat.busy and chat.items[0][2] is item:
+            self._schedule(chat_id, chat)
+        return fut
+
+    def _schedule(self, chat_id, chat: _Chat):
+        chat.version += 1
+        prio, seq, _ = chat.items[0]
+        delay = chat.bucket.delay(time.monotonic())
+        if delay > 0:
+            heapq.heappush(self._cooling, (time.monotonic() + delay, chat.version, chat_id))
+        else:
+            heapq.heappush(self._ready, (prio, seq, chat.version, chat_id))
+        self._wakeup.set()
+
+    # ---- диспетчер ----
+    def _next_chat(self) -> Tuple[Optional[Any], float]:
+        """Следующий чат к отправке или (None, сколько ждать)."""
+        now = time.monotonic()
+        while self._cooling and self._cooling[0][0] <= now:
+            _, version, chat_id = heapq.heappop(self._cooling)
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.version == version and chat.items:
+                prio, seq, _ = chat.items[0]
+                heapq.heappush(self._ready, (prio, seq, version, chat_id))
+        while self._ready:
+            _, _, version, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.version != version or chat.busy or not chat.items:
+                continue
+            delay = chat.bucket.delay(now)
+            if delay > 0:
+                heapq.heappush(self._cooling, (now + delay, version, chat_id))
+                continue
+            return chat_id, 0.0
+        wait = self._cooling[0][0] - now if self._cooling else None
+        return None, wait
+
+    async def _run(self):
+        while True:
+            chat_id, wait = self._next_chat()
+            if chat_id is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.monotonic()
+            delay = max(b.delay(now) for b in self._buckets)
+            if delay > 0:
+                # вернём чат в очередь: за время ожидания может прийти более срочное
+                chat = self._chats[chat_id]
+                prio, seq, _ = chat.items[0]
+                heapq.heappush(self._ready, (prio, seq, chat.version, chat_id))
+                await asyncio.sleep(delay)
+                continue
+
+            await self._inflight.acquire()
+            now = time.monotonic()
+            for b in self._buckets:
+                b.take(now)
+            chat = self._chats[chat_id]
+            chat.bucket.take(now)
+            chat.busy = True
+            _, _, item = heapq.heappop(chat.items)
+            asyncio.get_running_loop().create_task(self._send(chat_id, chat, item))
+
+    async def _send(self, chat_id, chat: _Chat, item: _Item):
+        retry_in = None
+        try:
+            if item.future.cancelled():
+                raise asyncio.CancelledError  # ждать ответа уже некому — не отправляем
+            result = await item.call()
+        except asyncio.CancelledError:
+            pass
+        except RetryAfter as e:
+            sec = _retry_after_sec(e)
+            self.retry_after += 1
+            logger.warning("Telegram RetryAfter %.0f c (чат %s), ставим очередь на паузу", sec, chat_id)
+            now = time.monotonic()
+            for b in self._pause:
+                b.pause(sec, now)
+            chat.bucket.pause(sec, now)
+            retry_in = 0.0                     # пауза уже в bucket'ах; попытку не считаем
+        except BadRequest as e:
+            self._fail(item, e)
+        except NetworkError as e:   # и TimedOut
+            item.attempt += 1
+            if not _never_sent(e) or item.attempt > SEND_MAX_RETRIES:
+                self._fail(item, e)
+            else:
+                retry_in = SEND_BACKOFF * 2 ** (item.attempt - 1)
+                self.retried += 1
+                logger.warning("Ошибка отправки в %s (%s), повтор через %.0f c", chat_id, e, retry_in)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._inflight.release()
+
+        if retry_in:
+            await asyncio.sleep(retry_in)
+        if retry_in is not None:
+            heapq.heappush(chat.items, (item.priority, item.seq, item))   # тот же порядок в чате
+        chat.busy = False
+        if chat.items:
+            self._schedule(chat_id, chat)
+        elif chat.bucket.idle(time.monotonic()):
+            self._chats.pop(chat_id, None)
+        else:
+            self._prune()
+
+    def _fail(self, item: _Item, e: Exception):
+        self.failed += 1
+        if not item.future.done():
+            item.future.set_exception(e)
+
+    def _prune(self):
+        """Забываем чаты без сообщений, у которых bucket уже полный."""
+        if len(self._chats) < 10000:
+            return
+        now = time.monotonic()
+        for chat_id in [c for c, ch in self._chats.items()
+                        if not ch.items and not ch.busy and ch.bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(c.items) for c in self._chats.values()),
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "retried": self.retried,
+            "retry_after": self.retry_after,
+            "failed": self.failed,
+        }
+
+
+_global_bucket = TokenBucket(SEND_RATE, SEND_BURST)
+_queues: Dict[str, SendQueue] = {}
+_lane_bots: Dict[str, Any] = {}
+
+
+def lane_of(priority: int) -> str:
+    return LANE_BULK if priority >= PRIORITY_BULK else LANE_INTERACTIVE
+
+
+def get_queue(lane: str = LANE_INTERACTIVE) -> SendQueue:
+    q = _queues.get(lane)
+    if q is None:
+        if lane == LANE_BULK:
+            own = TokenBucket(BULK_RATE, SEND_BURST)
+            q = SendQueue([_global_bucket, own], BULK_MAX_INFLIGHT, pause=[own])
+        else:
+            q = SendQueue([_global_bucket], SEND_MAX_INFLIGHT)
+        _queues[lane] = q
+    return q
+
+
+def set_lane_bot(lane: str, bot):
+    """Свой Bot (со своим пулом соединений) для полосы; None — слать переданным bot."""
+    if bot is None:
+        _lane_bots.pop(lane, None)
+    else:
+        _lane_bots[lane] = bot
+
+
+# ====== Отправка ======
+async def send_message(bot, chat_id, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+    """bot.send_message через очередь своей полосы; вернёт Message, когда сообщение уйдёт."""
+    lane = lane_of(priority)
+    bot = _lane_bots.get(lane, bot)
+    return await get_queue(lane).submit(
+        chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority
+    )
+
+
+def queue_stats() -> dict:
+    return {lane: q.stats() for lane, q in _queues.items()}
@@ -1,17 +1,24 @@
 # --- Отправка уведомлений ---
-from telegram.constants import ParseMode
-import json
+import asyncio
 import os
+import time
 from datetime import datetime, timedelta, time as dtime
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CallbackQueryHandler, ContextTypes
-from fa_api import FaAPI  # твоя библиотека расписаний
-from homework import send_homework_for_date
-from schedule_groups import _to_api_date, _filter_lessons_by_date, _fmt_day
-
-fa = FaAPI()  # создаём объект API
-
-FAV_FILE = "favorites.json"
+from schedule_groups import _to_api_date, get_day_digest, send_day_digest
+from notify_scheduler import NotificationScheduler
+import send_queue as SQ  # исходящие сообщения с учётом лимитов Telegram
+import delivery_ledger as DL  # уведомление уходит не больше одного раза за слот
+import lanes  # фоновая полоса: свои пулы потоков для рассылки
+import user_store as US  # настройки пользователей (SQLite)
+from paths import DATA_DIR
+
+WARMUP_LEAD_MIN = 10  # за сколько минут до уведомления прогревать расписания
+NOTIFY_CONCURRENCY = 20  # сколько пользователей слота обслуживаем одновременно
+NOTIFY_STATE_FILE = os.path.join(DATA_DIR, "notify_state.json")  # последняя обработанная минута
+NOTIFY_CATCHUP_GRACE_MIN = int(os.getenv("NOTIFY_CATCHUP_GRACE_MIN", "30"))  # досылать пропущенное за простой не дольше
+DEFAULT_NOTIFY_TIMES = ["19:00"]
+DEFAULT_SCHEDULE_DAY = "tomorrow"
 
 START_TEXT = (
     "Привет! 👋\n"
@@ -28,18 +35,6 @@ START_KEYBOARD = InlineKeyboardMarkup(
 )
 
 
-# --- Работа с файлом избранных ---
-def load_favorites():
-    if not os.path.exists(FAV_FILE):
-        return {}
-    with open(FAV_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_favorites(data):
-    with open(FAV_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-
 # --- Главное меню настроек ---
 async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -68,9 +63,8 @@ async def choose_notify_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     q = update.callback_query
     await q.answer()
 
-    user_id = str(update.effective_user.id)
-    data = load_favorites()
-    user_data = data.get(user_id, {})
+    user_id = update.effective_user.id
+    user_data = US.get_user(user_id) or {}
     selected = set(user_data.get("notify_times", []))
 
     times = [f"{h:02d}:00" for h in range(6, 24)]
@@ -107,11 +101,7 @@ async def set_day_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
-    user_id = str(update.effective_user.id)
-    data = load_favorites()
-    user_data = data.setdefault(user_id, {})
-    user_data["schedule_day"] = "today"
-    save_favorites(data)
+    US.update_user(update.effective_user.id, lambda info: info.update(schedule_day="today"))
 
     text = "✅ Уведомления будут приходить на <b>сегодня</b>."
     keyboard = [[InlineKeyboardButton("📋 В меню", callback_data="settings_back")]]
@@ -123,11 +113,7 @@ async def set_day_tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
-    user_id = str(update.effective_user.id)
-    data = load_favorites()
-    user_data = data.setdefault(user_id, {})
-    user_data["schedule_day"] = "tomorrow"
-    save_favorites(data)
+    US.update_user(update.effective_user.id, lambda info: info.update(schedule_day="tomorrow"))
 
     text = "✅ Уведомления будут приходить на <b>завтра</b>."
     keyboard = [[InlineKeyboardButton("📋 В меню", callback_data="settings_back")]]
@@ -140,20 +126,24 @@ async def toggle_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     time_str = q.data.replace("toggle_time_", "")
 
-    user_id = str(update.effective_user.id)
-    data = load_favorites()
-    user_data = data.setdefault(user_id, {})
-    times = set(user_data.get("notify_times", []))
-
-    if time_str in times:
-        times.remove(time_str)
+    user_id = update.effective_user.id
+
+    def _toggle(info):
+        times = set(info.get("notify_times", []))
+        if time_str in times:
+            times.remove(time_str)
+        else:
+            times.add(time_str)
+        info["notify_times"] = sorted(times)
+
+    # несколько нажатий подряд попадут в базу одной записью (user_store)
+    user_data = US.update_user(user_id, _toggle)
+    times = set(user_data["notify_times"])
+    # меняем только этот слот этого пользователя
+    if time_str in times and user_data.get("groups"):
+        notify_scheduler.add(user_id, time_str)
     else:
-        times.add(time_str)
-
-    user_data["notify_times"] = sorted(times)
-    save_favorites(data)
-    # пересоздаём задачи с учётом нового выбора
-    register_notification_jobs(context.application)
+        notify_scheduler.remove(user_id, time_str)
 
     await choose_notify_time(update, context)
 
@@ -163,137 +153,182 @@ async def disable_notifications(update: Update, context: ContextTypes.DEFAULT_TY
     q = update.callback_query
     await q.answer()
 
-    user_id = str(update.effective_user.id)
-    data = load_favorites()
-    user_data = data.get(user_id)
-    if user_data:
-        user_data["notify_times"] = []
-        save_favorites(data)
+    user_id = update.effective_user.id
+    if US.get_user(user_id) is not None:
+        US.update_user(user_id, lambda info: info.update(notify_times=[]))
 
-    # удаляем все задачи из JobQueue
-    for job in context.application.job_queue.jobs():
-        if job.data and job.data.get("user_id") == int(user_id):
-            job.schedule_removal()
+    # убираем пользователя из всех корзин планировщика
+    notify_scheduler.clear_user(user_id)
 
     await q.edit_message_text(
         "🔕 Уведомления успешно отключены.\nВы всегда можете снова включить их через меню."
     )
 
 
-# --- отправка уведомлений с расписанием и дз ---
-async def send_notifications(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    if not chat_id:
-        # нет адресата — тихо выходим
-        return
-    chat_id = int(chat_id)
-    today = datetime.now().date()
-
-    # Загружаем избранные группы пользователя
-    try:
-        with open(FAV_FILE, "r", encoding="utf-8") as f:
-            favorites = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        favorites = {}
-
-    user_data = favorites.get(str(chat_id))
-    if not user_data or "groups" not in user_data or not user_data["groups"]:
-        await context.bot.send_message(chat_id, "❗ У вас нет избранных групп для уведомлений.")
-        return
+# --- Прогрев расписаний перед уведомлениями ---
+def _notify_target_date(info, today):
+    if info.get("schedule_day", "tomorrow") == "today":
+        return today
+    return today + timedelta(days=1)
 
-    # Определяем день для уведомления (по умолчанию завтра)
-    day_pref = user_data.get("schedule_day", "tomorrow")
-    if day_pref == "today":
-        target_date = today
-    else:
-        target_date = today + timedelta(days=1)
 
-    ds = _to_api_date(target_date)
+def _slot_plan(favorites, slot: str, user_ids, today):
+    """
+    Кому что отправить в слоте: {chat_id: (дата, [(gid, ds, gname), ...])}; пустой список — групп нет.
+    Одинаковые (группа, дата) у разных пользователей — один и тот же ключ.
+    """
+    plan = {}
+    for user_id in user_ids:
+        info = favorites.get(str(user_id)) or {}
+        if slot not in (info.get("notify_times") or []):
+            continue
+        groups = [g for g in info.get("groups") or [] if g.get("id") and g.get("name")]
+        ds = _to_api_date(_notify_target_date(info, today))
+        plan[int(user_id)] = (ds, [(str(g["id"]), ds, g["name"]) for g in groups])
+    return plan
 
-    # Для каждой группы — отправляем расписание и дз
-    for group in user_data["groups"]:
-        gid = group.get("id")
-        gname = group.get("name")
 
-        if not gid or not gname:
-            continue
+async def warmup_notifications(context: ContextTypes.DEFAULT_TYPE, slot: str, user_ids, day=None):
+    """За WARMUP_LEAD_MIN минут до слота собирает дайджесты всех групп этого слота (digest_cache)."""
+    started = time.monotonic()
+    today = day or datetime.now().date()
+
+    favorites = US.get_users(user_ids)  # из памяти user_store
+    plan = _slot_plan(favorites, slot, user_ids, today)
+    pairs = {key for _, keys in plan.values() for key in keys}
+
+    with lanes.background():  # FaAPI и блокирующий I/O — в пулах фоновой полосы
+        results = await asyncio.gather(*(get_day_digest(*key) for key in pairs), return_exceptions=True)
+    failed = sum(1 for r in results if isinstance(r, Exception))
+    print(f"[WARMUP] {slot}: прогрето групп {len(pairs) - failed}/{len(pairs)} "
+          f"за {time.monotonic() - started:.2f} с")
+
 
+# --- отправка уведомлений с расписанием и дз ---
+async def send_notifications(context: ContextTypes.DEFAULT_TYPE, slot: str, user_ids, day=None):
+    """
+    Уведомления всем пользователям слота slot — одним пакетом.
+    Каждая пара (группа, дата) загружается и форматируется один раз,
+    готовый текст рассылается всем её подписчикам.
+    day — дата слота (при досылке после простоя может быть вчерашней).
+    """
+    started = time.monotonic()
+    today = day or datetime.now().date()
+
+    # Настройки пользователей слота — из памяти user_store, без обращения к базе
+    favorites = US.get_users(user_ids)
+
+    plan = _slot_plan(favorites, slot, user_ids, today)
+
+    # Журнал доставки: кому уже отправляли этот слот на эту дату — не шлём повторно
+    claimed = await lanes.run_bulk(
+        DL.claim_many, slot, [(chat_id, ds) for chat_id, (ds, _) in plan.items()]
+    )
+    plan = {chat_id: item for chat_id, item in plan.items() if (chat_id, item[0]) in claimed}
+    pairs = {key for _, keys in plan.values() for key in keys}
+
+    # 1️⃣ Один раз на пару: готовый дайджест (расписание и ДЗ), чаще всего уже из памяти
+    rendered = {}  # (gid, ds, gname) -> Digest | Exception
+
+    async def _render(key):
         try:
-            raw = fa.timetable_group(gid)  # вызываем через объект fa
-            lessons = _filter_lessons_by_date(raw, ds)
-            text = _fmt_day(ds, lessons, gname)
-
-            # 1️⃣ Отправляем расписание
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=ParseMode.HTML
-            )
+            rendered[key] = await get_day_digest(*key)
+        except Exception as e:
+            rendered[key] = e
+
+    with lanes.background():  # FaAPI и блокирующий I/O — в пулах фоновой полосы
+        await asyncio.gather(*(_render(key) for key in pairs))
+
+    # 2️⃣ Рассылка готовых текстов
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
 
-            # 2️⃣ Отправляем домашку (если есть)
-            date_str = target_date.strftime("%d.%m.%Y")
+    async def _one(chat_id, keys):
+        async with sem:
             try:
-                await send_homework_for_date(None, context, gname, date_str)
+                await _deliver(context, chat_id, keys, rendered)
             except Exception as e:
-                print(f"[WARN] Ошибка при отправке ДЗ для {gname}: {e}")
+                print(f"[WARN] Уведомление {chat_id} ({slot}) не отправлено: {e}")
 
-        except Exception as e:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"⚠️ Не удалось получить расписание для {gname}: {e}"
+    await asyncio.gather(*(_one(chat_id, keys) for chat_id, (_, keys) in plan.items()))
+    print(f"[NOTIFY] {slot}: пользователей {len(plan)}, пар группа/дата {len(pairs)} "
+          f"за {time.monotonic() - started:.2f} с, повторов подавлено всего {DL.stats()['suppressed']}")
+
+
+async def _deliver(context: ContextTypes.DEFAULT_TYPE, chat_id: int, keys, rendered):
+    if not keys:
+        await SQ.send_message(context.bot, chat_id, "❗ У вас нет избранных групп для уведомлений.",
+                              priority=SQ.PRIORITY_BULK)
+        return
+
+    # Для каждой группы — отправляем расписание и дз
+    for key in keys:
+        digest = rendered[key]
+        if isinstance(digest, Exception):
+            await SQ.send_message(
+                context.bot, chat_id, f"⚠️ Не удалось получить расписание для {key[2]}: {digest}",
+                priority=SQ.PRIORITY_BULK,
             )
+            continue
 
+        await send_day_digest(context.bot, chat_id, digest, priority=SQ.PRIORITY_BULK)
 
-def register_notification_jobs(application):
-    """Перерегистрировать уведомления для всех пользователей"""
-    import datetime as _dt
-    import zoneinfo
 
-    tz = getattr(application.job_queue, "timezone", zoneinfo.ZoneInfo("Europe/Moscow"))
-    now = _dt.datetime.now(tz)
-    data = load_favorites()
+notify_scheduler = NotificationScheduler(
+    send_notifications, warmup_notifications, WARMUP_LEAD_MIN,
+    state_path=NOTIFY_STATE_FILE, grace_min=NOTIFY_CATCHUP_GRACE_MIN,
+)
+
+
+def apply_notify_defaults(info) -> bool:
+    """Время и день уведомлений по умолчанию для пользователя с группами; True — если что-то заполнили."""
+    if not info.get("groups"):
+        return False
+    changed = False
+    if not info.get("schedule_day"):
+        info["schedule_day"] = DEFAULT_SCHEDULE_DAY
+        changed = True
+    # пустой список — пользователь сам отключил уведомления, не трогаем
+    if "notify_times" not in info:
+        info["notify_times"] = list(DEFAULT_NOTIFY_TIMES)
+        changed = True
+    return changed
+
+
+def sync_user_notifications(user_id, info):
+    """Обновить слоты одного пользователя в планировщике (после смены групп или времени)."""
+    slots = (info.get("notify_times") or []) if info.get("groups") else []
+    notify_scheduler.set_user_slots(int(user_id), slots)
 
-    # Удаляем старые задачи пользователей
-    for job in application.job_queue.jobs():
-        if job.data and str(job.data.get("user_id")) in data:
-            job.schedule_removal()
 
+def register_notification_jobs(application):
+    """
+    Перестроить индекс уведомлений для всех пользователей и запустить минутный тик.
+    Одно чтение базы, значения по умолчанию — в памяти, одна запись, индекс — одним проходом.
+    """
+    started = time.monotonic()
+    data = US.load_all()
+
+    subscriptions = {}
+    migrated = []
     for user_id, info in data.items():
         # Если у пользователя нет групп — пропускаем
         if not info.get("groups"):
             continue
 
         # Устанавливаем значения по умолчанию при необходимости
-        if not info.get("schedule_day"):
-            info["schedule_day"] = "tomorrow"
-            save_favorites(data)
-        if not info.get("notify_times"):
-            info["notify_times"] = ["19:00"]
-            save_favorites(data)
-
-        for t in info.get("notify_times", []):
-            h, m = map(int, t.split(":"))
-            target = now.replace(hour=h, minute=m, second=0, microsecond=0)
-
-            # Разовое уведомление на сегодня (если время ещё не прошло)
-            if target > now:
-                application.job_queue.run_once(
-                    send_notifications,
-                    when=(target - now).total_seconds(),
-                    data={"user_id": int(user_id)},
-                    chat_id=int(user_id),
-                    name=f"notify_{user_id}_{t}_once",
-                )
-
-            # Ежедневное уведомление
-            application.job_queue.run_daily(
-                send_notifications,
-                time=_dt.time(hour=h, minute=m),
-                data={"user_id": int(user_id)},
-                chat_id=int(user_id),
-                name=f"notify_{user_id}_{t}_daily",
-            )
+        if apply_notify_defaults(info):
+            migrated.append(user_id)
+
+        subscriptions[int(user_id)] = info.get("notify_times") or []
+
+    if migrated:
+        US.save_users(data, migrated)
+
+    notify_scheduler.replace_all(subscriptions)
+    notify_scheduler.start(application.job_queue)
+    print(f"[NOTIFY] Зарегистрировано: пользователей {len(data)}, с уведомлениями {len(subscriptions)}, "
+          f"дополнено по умолчанию {len(migrated)}, {notify_scheduler.stats()['slots']} слотов "
+          f"за {time.monotonic() - started:.3f} с")
 
 
 # --- Возврат в меню расписаний (плавно, без пересоздания сообщения) ---
@@ -0,0 +1,143 @@
+# teacher_directory.py
+"""
+Локальный справочник преподавателей.
+
+В памяти — индекс по нормализованным ФИО, кафедре и email: префиксы слов
+(«иван» найдёт «Иванов Иван Иванович») и триграммы ФИО для поиска с
+опечатками. Справочник хранится в файле, пополняется ответами источника
+и обновляется в фоне. Он может быть неполным, поэтому бот ищет в нём,
+только когда источник недоступен.
+"""
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+
+MIN_TRIGRAM_SCORE = 0.6   # доля триграмм запроса, найденных в ФИО
+
+
+def _norm(s: str) -> str:
+    return (s or "").strip().lower().replace("ё", "е")
+
+
+def _trigrams(s: str) -> Set[str]:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class TeacherDirectory:
+    """
+    fio(t) — полное ФИО записи источника (в боте это _teacher_fio_any),
+    extra(t) — дополнительные поля для поиска (кафедра, email).
+    """
+
+    def __init__(self, path: str, fio: Callable[[dict], str], extra: Callable[[dict], Iterable[str]]):
+        self.path = path
+        self._fio = fio
+        self._extra = extra
+        self._teachers: Dict[str, dict] = {}
+        self._words: List[Tuple[str, str]] = []          # (слово, id), отсортировано
+        self._by_trigram: Dict[str, Set[str]] = {}
+        self._names: Dict[str, str] = {}                 # id -> нормализованное ФИО
+        self.updated_at = None
+        self._lock = threading.Lock()   # save() идёт в отдельном потоке
+
+    def __len__(self):
+        return len(self._teachers)
+
+    # ---- индекс ----
+    def _rebuild(self):
+        words: List[Tuple[str, str]] = []
+        by_trigram: Dict[str, Set[str]] = {}
+        names: Dict[str, str] = {}
+        for tid, t in self._teachers.items():
+            name = _norm(self._fio(t))
+            names[tid] = name
+            fields = [name] + [_norm(x) for x in self._extra(t) if x]
+            for w in {w for f in fields for w in _WORD_RE.findall(f)}:
+                words.append((w, tid))
+            for g in _trigrams(name):
+                by_trigram.setdefault(g, set()).add(tid)
+        words.sort()
+        self._words, self._by_trigram, self._names = words, by_trigram, names
+
+    def add_many(self, teachers: Iterable[dict]) -> int:
+        """Добавить записи источника; вернёт число новых или изменившихся."""
+        changed = 0
+        with self._lock:
+            for t in teachers or []:
+                if not isinstance(t, dict) or t.get("id") is None:
+                    continue
+                tid = str(t["id"])
+                if self._teachers.get(tid) != t:
+                    self._teachers[tid] = t
+                    changed += 1
+            if changed:
+                self._rebuild()
+        return changed
+
+    def _prefix_ids(self, token: str) -> Set[str]:
+        out = set()
+        i = bisect.bisect_left(self._words, (token, ""))
+        while i < len(self._words) and self._words[i][0].startswith(token):
+            out.add(self._words[i][1])
+            i += 1
+        return out
+
+    def search(self, query: str, limit: int = 12) -> List[dict]:
+        """Каждое слово запроса — префикс какого-то слова записи; иначе — похожие ФИО."""
+        q = _norm(query)
+        tokens = _WORD_RE.findall(q)
+        if not tokens:
+            return []
+
+        ids = None
+        for tok in tokens:
+            found = self._prefix_ids(tok)
+            ids = found if ids is None else ids & found
+            if not ids:
+                break
+        if ids:
+            # выше те, у кого с запроса начинается само ФИО (фамилия)
+            ranked = sorted(ids, key=lambda i: (not self._names[i].startswith(tokens[0]), self._names[i]))
+            return [self._teachers[i] for i in ranked[:limit]]
+
+        grams = _trigrams(" ".join(tokens))
+        score: Dict[str, int] = {}
+        for g in grams:
+            for tid in self._by_trigram.get(g, ()):
+                score[tid] = score.get(tid, 0) + 1
+        best = [(n / len(grams), tid) for tid, n in score.items() if n / len(grams) >= MIN_TRIGRAM_SCORE]
+        best.sort(key=lambda x: (-x[0], self._names[x[1]]))
+        return [self._teachers[tid] for _, tid in best[:limit]]
+
+    # ---- файл ----
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._teachers = {str(t["id"]): t for t in data.get("teachers") or [] if t.get("id") is not None}
+            self.updated_at = data.get("updated_at")
+            self._rebuild()
+        except Exception as e:
+            logger.error(f"Ошибка чтения {self.path}: {e}")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.updated_at = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            teachers = list(self._teachers.values())
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"updated_at": self.updated_at, "teachers": teachers}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
@@ -1,4 +1,5 @@
 import asyncio
+import os
 from datetime import datetime, timedelta
 from collections import defaultdict
 import re
@@ -9,7 +10,12 @@ from telegram.ext import (
     CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, ConversationHandler, filters
 )
-from fa_api import FaAPI
+import fa_client as FC  # общий клиент FaAPI с пулом соединений
+import send_queue as SQ  # исходящие сообщения с учётом лимитов Telegram
+import timetable_store as TStore  # локальная копия расписаний
+from timetable_store import as_of_note
+from teacher_directory import TeacherDirectory
+from paths import DATA_DIR
 
 WELCOME_TEXT_MAIN = (
     "Привет! 👋\n"
@@ -184,7 +190,7 @@ def _parse_user_date(s: str) -> datetime | None:
 
 # ====== Вызовы fa_api в фоне ======
 def _fa_search_teacher(query: str):
-    fa = FaAPI()
+    fa = FC.get_client()
     return fa.search_teacher(query)  # список преподавателей
 
 def _norm(s: str) -> str:
@@ -197,13 +203,48 @@ def _t_name(t: dict) -> str:
     )
 
 def _fa_timetable_teacher(teacher_id, start: datetime, end: datetime):
-    fa = FaAPI()
+    fa = FC.get_client()
     s = start.strftime("%Y.%m.%d")
     e = end.strftime("%Y.%m.%d")
     return fa.timetable_teacher(teacher_id, s, e)
 
+# одинаковые одновременные запросы уходят в источник один раз
+async def _search_teacher(query: str):
+    return await FC.call(("search_teacher", _norm(query)), _fa_search_teacher, query)
+
+async def _timetable_teacher(teacher_id, start: datetime, end: datetime):
+    """
+    Расписание преподавателя за период: (записи, as_of).
+    Успешный ответ сохраняется локально; если источник упал, а все дни
+    периода есть в локальной копии — отдаём их, as_of = время снимка.
+    """
+    key = ("timetable_teacher", str(teacher_id), _to_fa_date(start), _to_fa_date(end))
+    days = [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+    try:
+        raw = await FC.call(key, _fa_timetable_teacher, teacher_id, start, end)
+    except Exception as e:
+        if not _is_source_down(e):
+            raise
+        saved = await asyncio.to_thread(TStore.load_teacher_days, teacher_id, days)
+        if len(saved) < len(days):
+            raise
+        records = [r for d in days for r in saved[d][0]]
+        return records, min(ts for _, ts in saved.values())
+
+    by_day = {d: [] for d in days}
+    for r in raw or []:
+        if r.get("date") in by_day:
+            by_day[r["date"]].append(r)
+    try:
+        await asyncio.to_thread(TStore.save_teacher_days, teacher_id, by_day)
+    except Exception:
+        pass  # локальная копия — не повод не показать расписание
+    return raw, None
+
 # ====== Определяем, что источник упал ======
 def _is_source_down(exc: Exception) -> bool:
+    if isinstance(exc, (FC.SourceUnavailable, FC.QueueTimeout)):
+        return True  # предохранитель разомкнут или очередь перегружена — запрос даже не отправлялся
     msg = str(exc).lower()
     # частые сигнатуры сетевых/HTTP-ошибок
     needles = [
@@ -237,7 +278,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def _send_period_by_days(chat, teacher_id: int, start: datetime, end: datetime, teacher_name: str):
     try:
-        raw = await asyncio.to_thread(_fa_timetable_teacher, teacher_id, start, end)
+        raw, as_of = await _timetable_teacher(teacher_id, start, end)
     except Exception as e:
         await chat.send_message(f"Ошибка при запросе расписания: {e}")
         return
@@ -251,10 +292,14 @@ async def _send_period_by_days(chat, teacher_id: int, start: datetime, end: date
     for r in raw:
         by_date[r["date"]].append(r)
 
-    # Шлём по одному сообщению на каждый день
+    # Шлём по одному сообщению на каждый день (через очередь: лимиты Telegram на чат)
+    bot = chat.get_bot()
     for day in sorted(by_date.keys()):
         text = _fmt_day(by_date[day], teacher_fallback=teacher_name)
-        await chat.send_message(text, parse_mode=ParseMode.HTML)
+        await SQ.send_message(bot, chat.id, text, priority=SQ.PRIORITY_HIGH, parse_mode=ParseMode.HTML)
+    if as_of:
+        await SQ.send_message(bot, chat.id, as_of_note(as_of).strip(), priority=SQ.PRIORITY_HIGH,
+                              parse_mode=ParseMode.HTML)
 
 def _pick_first(*vals) -> str:
     for v in vals:
@@ -294,26 +339,63 @@ def _teacher_fio_any(t: dict) -> str:
     # 4) fallback — id
     return f"id:{t.get('id')}"
 
+# ====== Локальный справочник преподавателей ======
+TEACHERS_FILE = os.path.join(DATA_DIR, "teachers.json")
+TEACHERS_REFRESH_INTERVAL = 24 * 60 * 60  # сек
+_SEED_LETTERS = "АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЩЭЮЯ"
+
+def _teacher_extra(t: dict):
+    dept = _pick_first(t.get("department"), t.get("chair"), t.get("cathedra"))
+    email = _pick_first(t.get("email"), t.get("lecturerEmail"))
+    return dept, email
+
+_directory = TeacherDirectory(TEACHERS_FILE, fio=_teacher_fio_any, extra=_teacher_extra)
+_directory.load()
+
+async def refresh_teacher_directory(context):
+    """Фоновое обновление справочника: поиск в источнике по первой букве фамилии."""
+    found = []
+    for letter in _SEED_LETTERS:
+        if not FC.source_available():
+            break
+        try:
+            found.extend(await _search_teacher(letter) or [])
+        except Exception:
+            continue  # источник недоступен — обновим в следующий раз
+    if _directory.add_many(found):
+        await asyncio.to_thread(_directory.save)
+
 async def on_teacher_surname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = (update.message.text or "").strip()
     if not query:
         await update.message.reply_text("Пустой ввод. Введите фамилию преподавателя:")
         return ASK_TEACHER
 
-    await update.message.reply_text("Ищу преподавателя…")
+    # ищем в источнике; локальный справочник неполный (однофамильцев в нём может не быть),
+    # поэтому он — только запасной путь, когда источник недоступен
     try:
-        teachers = await asyncio.to_thread(_fa_search_teacher, query)
+        if not FC.source_available():
+            raise FC.SourceUnavailable("FaAPI: источник недоступен")
+        await update.message.reply_text("Ищу преподавателя…")
+        teachers = await _search_teacher(query)
     except Exception as e:
-        if _is_source_down(e):
+        if not _is_source_down(e):
+            # прочие ошибки — показываем кратко
+            await update.message.reply_text(f"Ошибка при поиске преподавателя: {e}")
+            return ConversationHandler.END
+        teachers = _directory.search(query)
+        if not teachers:
             await update.message.reply_text(
                 "Похоже, источник с расписанием сейчас <b>не работает</b>. "
                 "Мы не можем дать ответ. Попробуйте позже.",
                 parse_mode=ParseMode.HTML
             )
             return ConversationHandler.END
-        # прочие ошибки — показываем кратко
-        await update.message.reply_text(f"Ошибка при поиске преподавателя: {e}")
-        return ConversationHandler.END
+        local_only = True
+    else:
+        local_only = False
+        if _directory.add_many(teachers):
+            await asyncio.to_thread(_directory.save)
 
     #если нет препода
     if len(teachers) == 0:
@@ -322,8 +404,8 @@ async def on_teacher_surname(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return ASK_TEACHER
 
-    # если один — берём сразу
-    if len(teachers) == 1:
+    # если один — берём сразу (но не из справочника: там может не быть нужного однофамильца)
+    if len(teachers) == 1 and not local_only:
         t = teachers[0]
         context.user_data["teacher_id"] = t["id"]
         context.user_data["teacher_name"] = t.get("name") or t.get("full_name") or t.get("title") or "Преподаватель"
@@ -348,10 +430,9 @@ async def on_teacher_surname(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Сохраняем «чистое» ФИО для заголовков расписания
         teachers_map[str(t["id"])] = fio
 
-    await update.message.reply_text(
-        "Найдено несколько. Выберите преподавателя:",
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
+    text = ("Источник сейчас недоступен — вот похожие из сохранённого справочника. Выберите преподавателя:"
+            if local_only else "Найдено несколько. Выберите преподавателя:")
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons))
     context.user_data["teachers_map"] = teachers_map
     return CHOOSE_TEACHER
 
@@ -554,13 +635,15 @@ async def on_custom_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def _fetch_and_format(teacher_id, start: datetime, end: datetime, teacher_name: str, period: bool = False) -> str:
     try:
-        raw = await asyncio.to_thread(_fa_timetable_teacher, teacher_id, start, end)
+        raw, as_of = await _timetable_teacher(teacher_id, start, end)
     except Exception as e:
         if _is_source_down(e):
             return ("Похоже, источник с расписанием сейчас <b>не работает</b>.\n"
                     "Мы не можем дать ответ. Попробуйте позже.")
         return f"Ошибка при запросе расписания: {e}"
+    return _format_records(raw, start, end, teacher_name, period) + as_of_note(as_of)
 
+def _format_records(raw, start: datetime, end: datetime, teacher_name: str, period: bool) -> str:
     if not raw:
         if start == end:
             ds = start.strftime("%Y-%m-%d")
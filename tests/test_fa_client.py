@@ -0,0 +1,59 @@
+# tests/test_fa_client.py
+"""Предохранитель FaAPI должен судить об источнике, а не о длине нашей очереди."""
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fa_client as FC  # noqa: E402
+
+SLOW_CALL_SEC = 0.2
+
+
+def _source(delay: float):
+    def answer(n):
+        time.sleep(delay)
+        return n
+    return answer
+
+
+class BreakerTimingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._saved = FC._executor, FC._breaker, FC._flight
+        FC._executor = FC.FaExecutor(2)
+        FC._breaker = FC.CircuitBreaker(FC.BREAKER_WINDOW, FC.BREAKER_MIN_CALLS, FC.BREAKER_ERROR_RATE,
+                                        SLOW_CALL_SEC, FC.BREAKER_OPEN_SEC, FC.BREAKER_PROBES)
+        FC._flight = FC.SingleFlight()
+
+    def tearDown(self):
+        FC._executor._pool.shutdown(wait=True)
+        FC._executor, FC._breaker, FC._flight = self._saved
+
+    async def _burst(self, delay: float, calls: int):
+        fn = _source(delay)
+        return await asyncio.gather(*(FC.call(("test", n), fn, n) for n in range(calls)),
+                                    return_exceptions=True)
+
+    async def test_queue_heavy_burst_to_fast_source_keeps_breaker_closed(self):
+        # 40 запросов на 2 потока: последние ждут в очереди ~1 с, сам ответ — 0.02 с
+        results = await self._burst(0.02, 40)
+
+        self.assertEqual(results, list(range(40)))
+        stats = FC.breaker_stats()
+        self.assertEqual(stats["state"], FC.CircuitBreaker.CLOSED)
+        self.assertEqual(stats["trips"], 0)
+        self.assertEqual(stats["window_failures"], 0)
+
+    async def test_slow_source_still_opens_breaker(self):
+        await self._burst(SLOW_CALL_SEC + 0.05, 6)
+
+        stats = FC.breaker_stats()
+        self.assertEqual(stats["trips"], 1)
+        self.assertEqual(stats["state"], FC.CircuitBreaker.OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()
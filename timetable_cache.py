@@ -0,0 +1,278 @@
+# timetable_cache.py
+"""
+Общий кеш расписаний групп перед FaAPI.timetable_group.
+
+Расписание хранится по дням: ключ — (id группы, дата). День без пар тоже
+запоминается (пустой список), чтобы не спрашивать его снова. Любой
+запрошенный период (день, неделя, произвольный диапазон) планировщик
+превращает в минимальный набор запросов к источнику только за недостающие
+дни; подпериоды уже загруженных периодов отдаются из памяти.
+
+Свежий день отдаётся сразу; устаревший, но не старше STALE_TTL, — тоже сразу,
+а обновление идёт в фоне (stale-while-revalidate). Размер ограничен
+MAX_ENTRIES, вытесняются давно не запрашивавшиеся дни (LRU).
+
+Всё загруженное пишется в timetable_store (SQLite). Если источник не ответил,
+недостающие дни берутся оттуда, а у результата выставляется as_of.
+
+Когда загруженный день отличается от того, что было в кеше, вызываются
+подписчики on_change(gid, ds) — например, кеш готовых дайджестов.
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import fa_client as FC
+import lanes
+import timetable_store as store
+
+logger = logging.getLogger(__name__)
+
+# ====== Настройки ======
+FRESH_TTL = 15 * 60          # сек: день считается свежим
+STALE_TTL = 6 * 60 * 60      # сек: сколько ещё отдаём устаревший день, обновляя его в фоне
+MAX_ENTRIES = 20000          # максимум дней в памяти
+MERGE_GAP_DAYS = 7           # недостающие куски с разрывом не больше — одним запросом
+
+DATE_FMT_API = "%Y.%m.%d"
+
+FRESH, STALE = "fresh", "stale"
+
+
+class TimetableCache:
+    """LRU-кеш с TTL: знает, свежая запись, устаревшая или её нет."""
+
+    def __init__(self, fresh_ttl: float, stale_ttl: float, max_entries: int):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def peek(self, key: Hashable) -> Tuple[Optional[str], Any]:
+        """Вернёт (FRESH | STALE | None, значение)."""
+        entry = self._data.get(key)
+        if entry is not None:
+            ts, value = entry
+            self._data.move_to_end(key)
+            age = time.monotonic() - ts
+            if age < self.fresh_ttl:
+                self.hits += 1
+                return FRESH, value
+            if age < self.fresh_ttl + self.stale_ttl:
+                self.stale_hits += 1
+                return STALE, value
+        self.misses += 1
+        return None, None
+
+    def value(self, key: Hashable) -> Any:
+        """Значение без учёта свежести и статистики (None — нет записи)."""
+        entry = self._data.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, age: float = 0.0):
+        self._data[key] = (time.monotonic() - age, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+
+class Timetable(dict):
+    """
+    {'YYYY.MM.DD': [пары]} за каждый день периода.
+    as_of — время снимка, если часть дней взята из локальной копии
+    (источник недоступен); иначе None.
+    """
+    as_of: Optional[datetime] = None
+
+
+_cache = TimetableCache(FRESH_TTL, STALE_TTL, MAX_ENTRIES)
+_refreshing: Dict[Tuple[str, str, str], asyncio.Task] = {}
+_listeners: List[Callable[[str, str], None]] = []
+
+
+def on_change(callback: Callable[[str, str], None]):
+    """Подписаться на изменения дня: callback(gid, 'YYYY.MM.DD')."""
+    _listeners.append(callback)
+
+
+def _changed(gid: str, ds: str):
+    for callback in _listeners:
+        try:
+            callback(gid, ds)
+        except Exception as e:
+            logger.warning("Ошибка подписчика изменений расписания: %s", e)
+
+
+# ====== Даты ======
+def _days_between(date_begin: str, date_end: str) -> List[str]:
+    d = datetime.strptime(date_begin, DATE_FMT_API)
+    end = datetime.strptime(date_end, DATE_FMT_API)
+    out = []
+    while d <= end:
+        out.append(d.strftime(DATE_FMT_API))
+        d += timedelta(days=1)
+    return out
+
+
+_DATE_KEYS = ("date", "day", "date_str", "lesson_date", "start", "datetime")
+
+
+def _lesson_day(lesson: Any) -> Optional[str]:
+    """День занятия в формате API; источник кладёт дату под разными ключами."""
+    if not isinstance(lesson, dict):
+        return None
+    raw = next((lesson[k] for k in _DATE_KEYS if lesson.get(k)), None)
+    if isinstance(raw, str):
+        m = re.match(r"^(\d{4})[.\-/](\d{2})[.\-/](\d{2})", raw.strip())
+        if m:
+            return ".".join(m.groups())
+    return None
+
+
+# ====== Планировщик запросов ======
+def _plan(days: List[str]) -> List[Tuple[str, str]]:
+    """
+    Недостающие дни (по возрастанию) -> минимальный набор периодов для запроса.
+    Соседние куски с небольшим разрывом склеиваются: лишние дни в ответе
+    дешевле ещё одного запроса к источнику.
+    """
+    ranges: List[Tuple[str, str]] = []
+    for ds in days:
+        if ranges:
+            last_end = datetime.strptime(ranges[-1][1], DATE_FMT_API)
+            gap = (datetime.strptime(ds, DATE_FMT_API) - last_end).days - 1
+            if gap <= MERGE_GAP_DAYS:
+                ranges[-1] = (ranges[-1][0], ds)
+                continue
+        ranges.append((ds, ds))
+    return ranges
+
+
+async def _fetch_range(gid: str, date_begin: str, date_end: str) -> Dict[str, List[dict]]:
+    """Загрузить период из источника и разложить по дням (пустые дни — тоже)."""
+    raw = await FC.timetable_group(gid, date_begin, date_end)
+    by_day: Dict[str, List[dict]] = {ds: [] for ds in _days_between(date_begin, date_end)}
+
+    if isinstance(raw, dict):
+        items = []
+        for k, v in raw.items():
+            for les in (v or []):
+                items.append((_lesson_day({"date": k}), les))
+    else:
+        items = [(_lesson_day(les), les) for les in (raw or [])]
+
+    for ds, les in items:
+        if ds is None and date_begin == date_end:
+            ds = date_begin
+        if ds in by_day:
+            by_day[ds].append(les)
+
+    for ds, lessons in by_day.items():
+        if _cache.value((gid, ds)) != lessons:
+            _changed(gid, ds)
+        _cache.put((gid, ds), lessons)
+    try:
+        await lanes.run_io(store.save_group_days, gid, by_day)
+    except Exception as e:
+        logger.warning("Не удалось сохранить расписание %s локально: %s", gid, e)
+    return by_day
+
+
+async def _load_from_store(gid: str, days: List[str]) -> Tuple[Dict[str, List[dict]], Optional[datetime]]:
+    """Дни из локальной копии; None вместо времени, если каких-то дней там нет."""
+    saved = await lanes.run_io(store.load_group_days, gid, days)
+    if len(saved) < len(days):
+        return {}, None
+    return {ds: lessons for ds, (lessons, _) in saved.items()}, min(ts for _, ts in saved.values())
+
+
+def _refresh_in_background(gid: str, date_begin: str, date_end: str):
+    key = (gid, date_begin, date_end)
+    if key in _refreshing:
+        return
+
+    async def _run():
+        try:
+            with lanes.background():   # пользователь уже получил ответ — обновление не спешит
+                await _fetch_range(gid, date_begin, date_end)
+        except Exception as e:
+            logger.warning("Не удалось обновить расписание %s в фоне: %s", key, e)
+        finally:
+            _refreshing.pop(key, None)
+
+    _refreshing[key] = asyncio.create_task(_run())
+
+
+# ====== Публичные функции ======
+async def group_days(gid, date_begin: str, date_end: str) -> Timetable:
+    """
+    Расписание группы по дням за период (даты в формате FaAPI: YYYY.MM.DD).
+    В ответе есть каждый день периода; день без пар — пустой список.
+    Если источник недоступен и в локальной копии дней нет — пробрасывает ошибку.
+    """
+    gid = str(gid)
+    days = _days_between(date_begin, date_end)
+    result: Dict[str, List[dict]] = {}
+    missing: List[str] = []
+    stale: List[str] = []
+    as_of: Optional[datetime] = None
+
+    for ds in days:
+        state, lessons = _cache.peek((gid, ds))
+        if state is None:
+            missing.append(ds)
+            continue
+        result[ds] = lessons
+        if state == STALE:
+            stale.append(ds)
+
+    for s, e in _plan(missing):
+        try:
+            result.update(await _fetch_range(gid, s, e))
+        except Exception:
+            wanted = [ds for ds in _days_between(s, e) if ds not in result]
+            saved, saved_as_of = await _load_from_store(gid, wanted)
+            if saved_as_of is None:
+                raise
+            logger.warning("Источник недоступен, группа %s %s–%s из локальной копии", gid, s, e)
+            result.update(saved)
+            as_of = saved_as_of if as_of is None else min(as_of, saved_as_of)
+    for s, e in _plan(stale):
+        _refresh_in_background(gid, s, e)
+
+    out = Timetable((ds, result.get(ds, [])) for ds in days)
+    out.as_of = as_of
+    return out
+
+
+def warm_from_store(days_back: int = 1, days_ahead: int = 14) -> int:
+    """Загрузить в кеш сохранённые дни вокруг сегодняшнего (при старте бота). Вернёт число дней."""
+    today = datetime.now()
+    day_from = (today - timedelta(days=days_back)).strftime(DATE_FMT_API)
+    day_to = (today + timedelta(days=days_ahead)).strftime(DATE_FMT_API)
+    loaded = 0
+    for gid, ds, lessons, fetched_at in store.load_group_days_between(day_from, day_to):
+        age = (today - fetched_at).total_seconds()
+        if age < FRESH_TTL + STALE_TTL:
+            _cache.put((gid, ds), lessons, age=max(age, 0.0))
+            loaded += 1
+    return loaded
+
+
+def cache_stats() -> dict:
+    return dict(_cache.stats(), refreshing=len(_refreshing))
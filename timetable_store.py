@@ -0,0 +1,117 @@
+# timetable_store.py
+"""
+Локальное хранилище расписаний (SQLite): по группе и по преподавателю, по дням.
+
+Каждая успешная загрузка из источника записывается сюда. При старте бота
+отсюда прогревается кеш, а когда источник недоступен — отсюда отдаются
+последние известные данные с пометкой «данные на ЧЧ:ММ».
+"""
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from paths import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Конфигурация --------------------
+DB_PATH = os.path.join(DATA_DIR, "timetable.db")
+
+KIND_GROUP = "group"
+KIND_TEACHER = "teacher"
+
+
+# -------------------- SQLite --------------------
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_db():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = _connect()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS timetable_days (
+            kind TEXT,
+            owner_id TEXT,
+            day TEXT,
+            lessons TEXT,
+            fetched_at TEXT,
+            PRIMARY KEY (kind, owner_id, day)
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+
+def _save_days(kind: str, owner_id, by_day: Dict[str, list]):
+    fetched_at = datetime.now().isoformat(timespec="seconds")
+    rows = [(kind, str(owner_id), day, json.dumps(lessons, ensure_ascii=False), fetched_at)
+            for day, lessons in by_day.items()]
+    conn = _connect()
+    conn.executemany("INSERT OR REPLACE INTO timetable_days VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def _load_days(kind: str, owner_id, days: Iterable[str]) -> Dict[str, Tuple[list, datetime]]:
+    days = list(days)
+    if not days:
+        return {}
+    conn = _connect()
+    c = conn.cursor()
+    marks = ",".join("?" * len(days))
+    c.execute(
+        f"SELECT day, lessons, fetched_at FROM timetable_days "
+        f"WHERE kind = ? AND owner_id = ? AND day IN ({marks})",
+        (kind, str(owner_id), *days),
+    )
+    rows = c.fetchall()
+    conn.close()
+    return {day: (json.loads(lessons), datetime.fromisoformat(fetched_at)) for day, lessons, fetched_at in rows}
+
+
+# -------------------- Группы --------------------
+def save_group_days(gid, by_day: Dict[str, list]):
+    _save_days(KIND_GROUP, gid, by_day)
+
+
+def load_group_days(gid, days: Iterable[str]) -> Dict[str, Tuple[list, datetime]]:
+    return _load_days(KIND_GROUP, gid, days)
+
+
+def load_group_days_between(day_from: str, day_to: str) -> List[Tuple[str, str, list, datetime]]:
+    """Все сохранённые дни всех групп в периоде (для прогрева кеша при старте)."""
+    conn = _connect()
+    c = conn.cursor()
+    c.execute(
+        "SELECT owner_id, day, lessons, fetched_at FROM timetable_days "
+        "WHERE kind = ? AND day BETWEEN ? AND ?",
+        (KIND_GROUP, day_from, day_to),
+    )
+    rows = c.fetchall()
+    conn.close()
+    return [(gid, day, json.loads(lessons), datetime.fromisoformat(fetched_at))
+            for gid, day, lessons, fetched_at in rows]
+
+
+# -------------------- Преподаватели --------------------
+def save_teacher_days(teacher_id, by_day: Dict[str, list]):
+    _save_days(KIND_TEACHER, teacher_id, by_day)
+
+
+def load_teacher_days(teacher_id, days: Iterable[str]) -> Dict[str, Tuple[list, datetime]]:
+    return _load_days(KIND_TEACHER, teacher_id, days)
+
+
+# -------------------- Оформление --------------------
+def as_of_note(as_of: Optional[datetime]) -> str:
+    """Пометка для ответа из локальной копии (пустая строка, если данные свежие)."""
+    if as_of is None:
+        return ""
+    return (f"\n\n<i>⚠️ Источник сейчас недоступен — показаны данные "
+            f"на {as_of.strftime('%H:%M %d.%m')}.</i>")
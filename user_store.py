@@ -0,0 +1,417 @@
+# user_store.py
+"""
+Настройки пользователей (SQLite): избранные группы, время и день уведомлений.
+
+Раньше всё лежало в favorites.json, и каждое нажатие кнопки и каждое
+уведомление разбирали этот файл целиком. Здесь три таблицы с индексами
+по пользователю, по id группы и по времени уведомления; чтение настроек
+одного пользователя — выборка по ключу.
+
+Наружу данные отдаются в прежнем виде записи favorites.json:
+{"groups": [{"id": ..., "name": ...}], "notify_times": [...], "schedule_day": ...}.
+Ключа notify_times нет, если пользователь его ни разу не задавал; пустой
+список — уведомления отключены.
+
+При первом запуске содержимое favorites.json переносится сюда (import_favorites_json);
+отметка о переносе хранится в базе (таблица meta), сам файл не трогается.
+Это делается один раз в init_db при старте, а не при чтении. Пути считаются
+от папки модуля, а не от текущей директории.
+
+Все настройки держатся в памяти: чтение (клавиатуры, проверка «в избранном ли
+группа», уведомления) не трогает диск. База читается один раз при старте.
+
+Запись — отложенная: изменение сразу видно в памяти, а в базу уходит через
+FLUSH_DELAY секунд тишины (но не позже FLUSH_MAX_DELAY от первого изменения)
+одной транзакцией на всех изменённых пользователей. Несколько нажатий подряд
+(галочки времени уведомлений) — одна запись. Изменения одного пользователя
+делаются под блокировкой (update_user), так что не теряются. При остановке
+бота несохранённое дописывается (flush_on_shutdown).
+
+Рядом с записями в памяти — обратный индекс «группа → подписчики». Он
+обновляется при каждом изменении записи, так что выбрать популярные группы
+(для прогрева кеша) можно без прохода по всем пользователям. Индекс
+«время уведомления → пользователи» — один, в NotificationScheduler.
+"""
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from paths import BASE_DIR, DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Конфигурация --------------------
+DB_PATH = os.path.join(DATA_DIR, "users.db")
+LEGACY_FAV_FILE = os.path.join(BASE_DIR, "favorites.json")
+FLUSH_DELAY = 2.0        # сек тишины перед записью в базу
+FLUSH_MAX_DELAY = 10.0   # сек: дольше изменения в памяти не копим
+
+_users: Dict[int, dict] = {}            # user_id -> запись в формате favorites.json
+_fav_ids: Dict[int, frozenset] = {}     # user_id -> id избранных групп (для клавиатур)
+_group_users: Dict[str, Set[int]] = {}  # id группы -> подписчики
+_group_names: Dict[str, str] = {}       # id группы -> название
+_loaded = False
+_lock = threading.RLock()               # память и список изменённых
+_flush_lock = threading.Lock()          # записи в базу идут по одной
+
+_dirty: set = set()                     # user_id, ещё не записанные в базу
+_dirty_since: Optional[float] = None
+_timer: Optional[threading.Timer] = None
+_counters = {"mutations": 0, "flushes": 0, "written": 0}
+
+
+# -------------------- SQLite --------------------
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def init_db():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = _connect()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            schedule_day TEXT,
+            notify_times_set INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS fav_groups (
+            user_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE,
+            group_id TEXT,
+            group_name TEXT,
+            pos INTEGER,
+            PRIMARY KEY (user_id, group_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_fav_groups_group ON fav_groups (group_id);
+        CREATE TABLE IF NOT EXISTS notify_slots (
+            user_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE,
+            slot TEXT,
+            PRIMARY KEY (user_id, slot)
+        );
+        CREATE INDEX IF NOT EXISTS idx_notify_slots_slot ON notify_slots (slot);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    conn.commit()
+    conn.close()
+    import_favorites_json()
+    _load()
+
+
+# -------------------- Перенос из favorites.json --------------------
+def _normalize_legacy_entry(entry) -> dict:
+    """Старый формат: одна группа в ключе "group" вместо списка "groups"."""
+    if not isinstance(entry, dict):
+        return {"groups": []}
+    out = {k: v for k, v in entry.items() if k not in ("groups", "group")}
+    groups = entry.get("groups")
+    single = entry.get("group")
+    if isinstance(groups, list):
+        out["groups"] = [{"id": str(g["id"]), "name": str(g.get("name") or g["id"])}
+                         for g in groups if isinstance(g, dict) and g.get("id")]
+    elif isinstance(single, dict) and single.get("id"):
+        out["groups"] = [{"id": str(single["id"]),
+                          "name": str(single.get("name") or single.get("title") or single.get("group") or single["id"])}]
+    else:
+        out["groups"] = []
+    return out
+
+
+def import_favorites_json(path: str = LEGACY_FAV_FILE) -> int:
+    """Однократно перенести favorites.json в базу. Вернёт число перенесённых пользователей."""
+    if not os.path.exists(path):
+        return 0
+    conn = _connect()
+    try:
+        done = conn.execute("SELECT value FROM meta WHERE key = 'favorites_imported'").fetchone()
+    finally:
+        conn.close()
+    if done:
+        return 0
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка чтения {path}: {e}")
+        return 0
+    if not isinstance(data, dict):
+        data = {}
+    users = {}
+    for user_id, entry in data.items():
+        try:
+            users[int(user_id)] = _normalize_legacy_entry(entry)
+        except ValueError:
+            logger.warning("Пропускаю запись %r из %s", user_id, path)
+    conn = _connect()
+    try:
+        with conn:   # пользователи и отметка о переносе — одной транзакцией
+            for user_id, info in users.items():
+                _write_user(conn, user_id, info)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('favorites_imported', ?)",
+                         (datetime.now().isoformat(timespec="seconds"),))
+    finally:
+        conn.close()
+    logger.info("Перенесено %d пользователей из %s в %s", len(users), path, DB_PATH)
+    return len(users)
+
+
+# -------------------- Запись --------------------
+def _write_user(conn, user_id: int, info: dict):
+    user_id = int(user_id)
+    conn.execute(
+        "INSERT OR REPLACE INTO users (user_id, schedule_day, notify_times_set) VALUES (?, ?, ?)",
+        (user_id, info.get("schedule_day"), 1 if "notify_times" in info else 0),
+    )
+    conn.execute("DELETE FROM fav_groups WHERE user_id = ?", (user_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO fav_groups VALUES (?, ?, ?, ?)",
+        [(user_id, str(g["id"]), str(g.get("name") or g["id"]), pos)
+         for pos, g in enumerate(info.get("groups") or []) if g.get("id")],
+    )
+    conn.execute("DELETE FROM notify_slots WHERE user_id = ?", (user_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO notify_slots VALUES (?, ?)",
+        [(user_id, slot) for slot in info.get("notify_times") or []],
+    )
+
+
+def _write_users(users: Dict, user_ids: List):
+    """Записать пользователей в базу одной транзакцией: либо все, либо никто."""
+    conn = _connect()
+    try:
+        with conn:
+            for user_id in user_ids:
+                _write_user(conn, user_id, users[user_id])
+    finally:
+        conn.close()
+
+
+# -------------------- Чтение --------------------
+def _read_users(conn, where: str = "", args: tuple = ()) -> Dict[str, dict]:
+    out: Dict[str, dict] = {}
+    for user_id, schedule_day, notify_set in conn.execute(
+            f"SELECT user_id, schedule_day, notify_times_set FROM users {where}", args):
+        info = {"groups": []}
+        if schedule_day:
+            info["schedule_day"] = schedule_day
+        if notify_set:
+            info["notify_times"] = []
+        out[str(user_id)] = info
+    if not out:
+        return out
+    marks = ",".join("?" * len(out))
+    ids = tuple(int(u) for u in out)
+    for user_id, gid, gname in conn.execute(
+            f"SELECT user_id, group_id, group_name FROM fav_groups WHERE user_id IN ({marks}) "
+            f"ORDER BY user_id, pos", ids):
+        out[str(user_id)]["groups"].append({"id": gid, "name": gname})
+    for user_id, slot in conn.execute(
+            f"SELECT user_id, slot FROM notify_slots WHERE user_id IN ({marks}) ORDER BY user_id, slot", ids):
+        out[str(user_id)].setdefault("notify_times", []).append(slot)
+    return out
+
+
+# -------------------- Память --------------------
+def _copy(info: dict) -> dict:
+    """Копия записи: вызывающий код меняет её и сохраняет через update_user или save_users."""
+    out = dict(info)
+    out["groups"] = [dict(g) for g in info.get("groups") or []]
+    if "notify_times" in info:
+        out["notify_times"] = list(info["notify_times"] or [])
+    return out
+
+
+def _index_add(index: Dict, key, user_id: int):
+    index.setdefault(key, set()).add(user_id)
+
+
+def _index_discard(index: Dict, key, user_id: int):
+    users = index.get(key)
+    if users is not None:
+        users.discard(user_id)
+        if not users:
+            del index[key]
+
+
+def _unindex(user_id: int):
+    info = _users.get(user_id)
+    if info is None:
+        return
+    for gid in _fav_ids.get(user_id, ()):
+        _index_discard(_group_users, gid, user_id)
+        if gid not in _group_users:
+            _group_names.pop(gid, None)
+
+
+def _remember(user_id: int, info: dict):
+    """Положить запись в память и обновить обратные индексы."""
+    info = _copy(info)
+    _unindex(user_id)
+    _users[user_id] = info
+    _fav_ids[user_id] = frozenset(str(g["id"]) for g in info["groups"] if g.get("id"))
+    for g in info["groups"]:
+        if not g.get("id"):
+            continue
+        gid = str(g["id"])
+        _index_add(_group_users, gid, user_id)
+        _group_names[gid] = g.get("name") or gid
+
+
+def _load():
+    """Прочитать базу целиком в память (один раз)."""
+    global _loaded
+    conn = _connect()
+    try:
+        data = _read_users(conn)
+    finally:
+        conn.close()
+    with _lock:
+        for index in (_users, _fav_ids, _group_users, _group_names):
+            index.clear()
+        for user_id, info in data.items():
+            _remember(int(user_id), info)
+        _loaded = True
+    logger.info("Настройки %d пользователей загружены в память", len(_users))
+
+
+def _ensure_loaded():
+    if not _loaded:
+        _load()
+
+
+# -------------------- Чтение (из памяти) --------------------
+def get_user(user_id) -> Optional[dict]:
+    """Настройки пользователя (копия) или None, если его нет."""
+    _ensure_loaded()
+    info = _users.get(int(user_id))
+    return _copy(info) if info is not None else None
+
+
+def get_users(user_ids: Iterable) -> Dict[str, dict]:
+    """Настройки нескольких пользователей: {str(user_id): запись}."""
+    _ensure_loaded()
+    out: Dict[str, dict] = {}
+    for user_id in user_ids:
+        info = _users.get(int(user_id))
+        if info is not None:
+            out[str(user_id)] = _copy(info)
+    return out
+
+
+def load_all() -> Dict[str, dict]:
+    """Все пользователи (для регистрации уведомлений при старте)."""
+    _ensure_loaded()
+    return {str(user_id): _copy(info) for user_id, info in _users.items()}
+
+
+def fav_groups(user_id) -> List[dict]:
+    _ensure_loaded()
+    info = _users.get(int(user_id))
+    return [dict(g) for g in info["groups"]] if info else []
+
+
+def is_fav_group(user_id, gid) -> bool:
+    """Группа в избранном у пользователя — без копирования и без диска (для клавиатур)."""
+    _ensure_loaded()
+    return str(gid) in _fav_ids.get(int(user_id), ())
+
+
+# -------------------- Обратный индекс --------------------
+def top_groups(n: int = 10) -> List[Tuple[str, str, int]]:
+    """n групп с наибольшим числом подписчиков: [(id, название, подписчиков), ...]."""
+    _ensure_loaded()
+    with _lock:
+        top = heapq.nlargest(n, _group_users.items(), key=lambda item: len(item[1]))
+        return [(gid, _group_names.get(gid, gid), len(users)) for gid, users in top]
+
+
+# -------------------- Изменения (запись отложенная) --------------------
+def update_user(user_id, change: Callable[[dict], None]) -> dict:
+    """
+    Изменить настройки пользователя: change(запись) правит копию на месте.
+    Чтение-изменение-запись под блокировкой; вернёт копию новой записи.
+    """
+    _ensure_loaded()
+    user_id = int(user_id)
+    with _lock:
+        info = _users.get(user_id)
+        info = _copy(info) if info is not None else {"groups": []}
+        change(info)
+        _remember(user_id, info)
+        _mark_dirty([user_id])
+        return _copy(info)
+
+
+def save_users(users: Dict, user_ids: Optional[Iterable] = None):
+    """Заменить настройки многих пользователей (всех из users или только user_ids)."""
+    _ensure_loaded()
+    keys = list(users if user_ids is None else user_ids)
+    with _lock:
+        for key in keys:
+            _remember(int(key), users[key])
+        _mark_dirty([int(key) for key in keys])
+
+
+def _mark_dirty(user_ids: List[int]):
+    global _dirty_since
+    with _lock:
+        _counters["mutations"] += len(user_ids)
+        if not _dirty:
+            _dirty_since = time.monotonic()
+        _dirty.update(user_ids)
+        _schedule_flush()
+
+
+def _schedule_flush():
+    """Перезапустить таймер записи: FLUSH_DELAY тишины, но не позже FLUSH_MAX_DELAY."""
+    global _timer
+    if _timer is not None:
+        _timer.cancel()
+    delay = min(FLUSH_DELAY, max(0.0, _dirty_since + FLUSH_MAX_DELAY - time.monotonic()))
+    _timer = threading.Timer(delay, flush)
+    _timer.daemon = True
+    _timer.start()
+
+
+def flush():
+    """Записать в базу всё изменённое одной транзакцией."""
+    global _timer, _dirty_since
+    with _flush_lock:
+        with _lock:
+            if _timer is not None:
+                _timer.cancel()
+                _timer = None
+            if not _dirty:
+                return
+            user_ids = list(_dirty)
+            snapshot = {user_id: _copy(_users[user_id]) for user_id in user_ids}
+            _dirty.clear()
+            _dirty_since = None
+        try:
+            _write_users(snapshot, user_ids)
+        except Exception as e:
+            logger.error(f"Ошибка записи настроек пользователей: {e}")
+            with _lock:
+                _mark_dirty([u for u in user_ids if u not in _dirty])   # повторим позже
+            return
+        _counters["flushes"] += 1
+        _counters["written"] += len(user_ids)
+
+
+async def flush_on_shutdown(application):
+    """post_shutdown: дописать несохранённые изменения."""
+    flush()
+
+
+def stats() -> dict:
+    return dict(_counters, users=len(_users), groups=len(_group_users), pending=len(_dirty))